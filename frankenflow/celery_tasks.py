@@ -1,31 +1,106 @@
 import datetime
 import os
 import time
+import uuid
 
 from . import celery, utils
-from .tasks import task_map
+from .tasks import task_map, task
 
 
-@celery.task()
-def launch_job(job_info, context):
+def _create_job(job_info, context):
     assert job_info["task_type"] in task_map, "Unknown task."
     job_class = task_map[job_info["task_type"]]
 
     os.makedirs(job_info["working_dir"], exist_ok=True)
-    job = job_class(context=context,
-                    inputs=job_info["inputs"],
-                    working_dir=job_info["working_dir"],
-                    stdout=job_info["stdout"],
-                    stderr=job_info["stderr"],
-                    logfile=job_info["logfile"])
+    return job_class(context=context,
+                     inputs=job_info["inputs"],
+                     working_dir=job_info["working_dir"],
+                     stdout=job_info["stdout"],
+                     stderr=job_info["stderr"],
+                     logfile=job_info["logfile"])
+
+
+@celery.task()
+def launch_job(job_info, context):
+    job = _create_job(job_info=job_info, context=context)
+
+    # A previous attempt might have been interrupted.
+    checkpoint = job.load_checkpoint()
+    if checkpoint is not None:
+        job.add_log_entry("Resuming job from its last checkpoint.")
+
+    report = _launch_job_and_report(job=job, job_info=job_info,
+                                    context=context, checkpoint=checkpoint)
+
+    return report
 
-    report = _launch_job_and_report(job=job)
 
+@celery.task(bind=True)
+def resume_job(self, job_info, context):
+    """
+    Resume a job suspended in its run stage from its checkpoint.
+    """
+    job = _create_job(job_info=job_info, context=context)
+
+    # The job might have been reset or resumed by other means since.
+    checkpoint = job.load_checkpoint()
+    if checkpoint is None or \
+            checkpoint.get("resume_task_id") != self.request.id:
+        return {"status": "superseded"}
+
+    # Lets the flow manager know the job is no longer suspended.
+    def _resumed():
+        self.update_state(state="RESUMED")
+
+    report = _launch_job_and_report(job=job, job_info=job_info,
+                                    context=context, checkpoint=checkpoint,
+                                    resumed=_resumed)
+
+    return report
+
+
+def _suspend_job(job, job_info, context, report, wait_condition):
+    """
+    Schedule a check of the wait condition and free the worker.
+    """
+    job.add_log_entry("Suspending job. Checking again in %.1f seconds." %
+                      wait_condition.interval)
+    # The checkpoint must exist before the task can run.
+    resume_task_id = str(uuid.uuid4())
+    job.save_checkpoint(report=report,
+                        wait_condition=wait_condition.to_dict(),
+                        resume_task_id=resume_task_id)
+    resume_job.apply_async(args=(job_info, context),
+                           countdown=wait_condition.interval,
+                           task_id=resume_task_id)
+
+    report["status"] = "waiting"
+    report["resume_task_id"] = resume_task_id
     return report
 
 
-def _launch_job_and_report(job):
+def _launch_job_and_report(job, job_info=None, context=None,
+                           checkpoint=None, resumed=None):
+    """
+    Run all stages of a job.
+
+    The completion of each stage is checkpointed together with the state of
+    the job. Given a checkpoint, the job continues with the first stage
+    that has not been completed.
+
+    The run stage can return a WaitCondition. The job is then suspended and
+    resumed by a new celery task once the condition holds. This requires
+    ``job_info`` and ``context``. ``resumed`` is called once the wait
+    condition of a suspended job holds.
+    """
     report = {}
+    wait_condition = None
+    if checkpoint is not None:
+        job.set_state(checkpoint["state"])
+        report = checkpoint.get("report", {})
+        if checkpoint.get("wait_condition"):
+            wait_condition = task.WaitCondition(
+                **checkpoint["wait_condition"])
 
     stages = [
         ("001_check_pre_staging", "check_pre_staging"),
@@ -36,18 +111,43 @@ def _launch_job_and_report(job):
         ("006_generate_next_steps", "generate_next_steps")
     ]
 
+    # Skip all stages completed before. A suspended job continues in the
+    # run stage.
+    stages = [_i for _i in stages
+              if "end_time_stage" not in report.get(_i[0], {})]
 
     for current_stage, method_name in stages:
-        info = {}
-        report[current_stage]  = info
+        if current_stage in report:
+            info = report[current_stage]
+            _start = time.time() - info.get("runtime_stage", 0.0)
+        else:
+            info = {}
+            report[current_stage] = info
 
-        _start = time.time()
-        info["start_time_stage"] = str(datetime.datetime.now())
+            _start = time.time()
+            info["start_time_stage"] = str(datetime.datetime.now())
 
         try:
-            ret_val = getattr(job, method_name)()
+            if wait_condition is not None:
+                ret_val = job.check_wait_condition(wait_condition)
+                if ret_val is None:
+                    if resumed is not None:
+                        resumed()
+                    if wait_condition.then:
+                        ret_val = getattr(job, wait_condition.then)()
+                wait_condition = None
+            else:
+                ret_val = getattr(job, method_name)()
+            # The run stage can suspend the job.
+            if current_stage == "004_run" and \
+                    isinstance(ret_val, task.WaitCondition):
+                info["runtime_stage"] = time.time() - _start
+                info["suspensions"] = info.get("suspensions", 0) + 1
+                return _suspend_job(job=job, job_info=job_info,
+                                    context=context, report=report,
+                                    wait_condition=ret_val)
             # The fifth stage can be used to set new goals.
-            if current_stage == "005_check_post_run":
+            elif current_stage == "005_check_post_run":
                 if isinstance(ret_val, dict) and "new_goal" in ret_val:
                     report["new_goal"] = ret_val["new_goal"]
             # The last stage returns information about the next runs.
@@ -69,10 +169,11 @@ def _launch_job_and_report(job):
         info["end_time_stage"] = str(datetime.datetime.now())
         info["runtime_stage"] = _end - _start
 
+        job.save_checkpoint(report=report, wait_condition=None,
+                            resume_task_id=None)
         job.add_log_entry("Finished stage %s." % current_stage)
 
 
     report["status"] = "success"
 
     return report
-
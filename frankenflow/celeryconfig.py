@@ -13,5 +13,19 @@ CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_IGNORE_RESULT = False
+# Task events wake up the flow manager daemon as soon as a task finished.
+CELERY_SEND_EVENTS = True
+# Distinguishes running tasks from queued ones, e.g. before resuming a job.
+CELERY_TRACK_STARTED = True
+# Tasks are only acknowledged once they finished. If the worker process
+# running a task dies the task is rejected and delivered again right away
+# (celery >= 4). If the whole worker or its machine dies the broker only
+# delivers it again once the visibility timeout passed. Either way it
+# continues from its last checkpoint. The visibility timeout must be
+# longer than any task takes.
+CELERY_ACKS_LATE = True
+CELERY_REJECT_ON_WORKER_LOST = True
+CELERYD_PREFETCH_MULTIPLIER = 1
+BROKER_TRANSPORT_OPTIONS = {"visibility_timeout": 12 * 3600}
 
 CELERY_STATE_DB = "/tmp/celery_state_db"
@@ -86,4 +86,7 @@ class Config():
         self.assert_config()
 
     def __getitem__(self, item):
-        return self.config[item]
\ No newline at end of file
+        return self.config[item]
+
+    def get(self, item, default=None):
+        return self.config.get(item, default)
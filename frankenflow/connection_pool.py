@@ -0,0 +1,137 @@
+import os
+import threading
+
+import paramiko
+
+
+class SSHConnectionPool():
+    """
+    SSH connections and SFTP sessions keyed by the host name in the SSH
+    config.
+
+    The HPC login nodes throttle new connections so every worker process
+    keeps a single connection per host alive and shares it between all its
+    tasks. Connections are health checked whenever they are handed out and
+    are transparently replaced if they died.
+    """
+    def __init__(self, keepalive_interval=30, timeout=120):
+        self.keepalive_interval = keepalive_interval
+        self.timeout = timeout
+
+        self._lock = threading.RLock()
+        self._ssh_config = None
+        self._ssh_clients = {}
+        self._sftp_clients = {}
+
+        self.statistics = {"hits": 0, "misses": 0, "reconnects": 0}
+
+    def _lookup_host(self, host):
+        # Only parse the config once per process.
+        if self._ssh_config is None:
+            user_config_file = os.path.expanduser("~/.ssh/config")
+            ssh_config = paramiko.SSHConfig()
+            with open(user_config_file) as fh:
+                ssh_config.parse(fh)
+            self._ssh_config = ssh_config
+
+        return self._ssh_config.lookup(host)
+
+    def _connect(self, host):
+        info = self._lookup_host(host)
+
+        client = paramiko.SSHClient()
+        # Should be safe enough in our controlled environment.
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.load_system_host_keys()
+        client.connect(
+            # For some reason paramiko does not make it directly pluggable
+            # into the connect() method...
+            username=info["user"],
+            hostname=info["hostname"],
+            timeout=self.timeout)
+        client.get_transport().set_keepalive(self.keepalive_interval)
+        return client
+
+    def _is_alive(self, client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        # Actually sends something over the wire.
+        try:
+            transport.send_ignore()
+        except (paramiko.SSHException, EOFError, OSError):
+            return False
+        return True
+
+    def is_healthy(self, host):
+        """
+        False if a connection to the host has been handed out and is dead
+        by now.
+        """
+        with self._lock:
+            client = self._ssh_clients.get(host)
+            if client is None:
+                return True
+            transport = client.get_transport()
+            return transport is not None and transport.is_active()
+
+    def get_ssh_client(self, host):
+        """
+        Get a live SSH client connected to the given host.
+        """
+        with self._lock:
+            client = self._ssh_clients.get(host)
+            if client is not None and self._is_alive(client):
+                self.statistics["hits"] += 1
+                return client
+
+            if client is None:
+                self.statistics["misses"] += 1
+            else:
+                self.statistics["reconnects"] += 1
+                self.invalidate(host)
+
+            client = self._connect(host)
+            self._ssh_clients[host] = client
+            return client
+
+    def get_clients(self, host):
+        """
+        Get a live SSH client connected to the given host together with an
+        open SFTP session over the same connection.
+        """
+        with self._lock:
+            client = self.get_ssh_client(host)
+            sftp_client = self._sftp_clients.get(host)
+            if sftp_client is None or sftp_client.get_channel().closed:
+                sftp_client = client.open_sftp()
+                self._sftp_clients[host] = sftp_client
+            return client, sftp_client
+
+    def get_user_and_hostname(self, host):
+        info = self._lookup_host(host)
+        return info["user"], info["hostname"]
+
+    def invalidate(self, host):
+        """
+        Close and forget all connections to the host.
+        """
+        with self._lock:
+            sftp_client = self._sftp_clients.pop(host, None)
+            client = self._ssh_clients.pop(host, None)
+            for _i in (sftp_client, client):
+                if _i is None:
+                    continue
+                try:
+                    _i.close()
+                except Exception:
+                    pass
+
+    def close_all(self):
+        with self._lock:
+            for host in list(self._ssh_clients.keys()):
+                self.invalidate(host)
+
+
+# One pool per worker process.
+pool = SSHConnectionPool()
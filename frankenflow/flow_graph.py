@@ -1,4 +1,8 @@
+import collections
+import copy
 import datetime
+import heapq
+import itertools
 import json
 import os
 import uuid
@@ -9,27 +13,263 @@ import networkx.readwrite.json_graph
 from . import NoJobsLeft
 
 
+# Changes to these job attributes can change the scheduling of a job.
+_INDEXED_KEYS = ("job_status", "priority", "critical")
+
+
+class _Job(dict):
+    """
+    Attribute dictionary of a single job.
+
+    Jobs are routinely modified in-place by the flow manager. This notifies
+    the owning graph so it can keep its index of leaf jobs up-to-date and
+    journal the change.
+    """
+    def __init__(self, graph, job_id, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._graph = graph
+        self._job_id = job_id
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._graph._job_changed(self._job_id, key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._graph._job_changed(self._job_id, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        had_key = key in self
+        value = super().pop(key, *args)
+        if had_key:
+            self._graph._job_changed(self._job_id, key)
+        return value
+
+    # Copies are detached plain dictionaries - they must not be able to
+    # modify the graph.
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
 class FlowGraph():
+    """
+    The execution graph of the workflow.
+
+    Jobs without any outgoing edges (the leaves of the graph) are the only
+    ones that can be current or next jobs. They are kept in an index that is
+    incrementally updated whenever a job is added or modified so that
+    finding the next job does not have to look at the whole history of the
+    workflow.
+
+    The graph is stored as a snapshot (``graph.json`` in node-link format)
+    plus a journal file next to it. Every change to the graph is appended to
+    the journal as a small JSON record. Once the journal is long enough it
+    is compacted into a new snapshot. The snapshot is always written
+    atomically and the journal is replayed on top of it when loading. Both
+    files are compacted when loading so the snapshot is up-to-date whenever
+    a flow manager starts.
+    """
+    # Number of journal records after which it is compacted into a new
+    # snapshot.
+    compaction_interval = 500
+
     def __init__(self, filename):
         self.filename = filename
-        if os.path.exists(self.filename):
+        self.journal_filename = os.path.splitext(filename)[0] + ".journal"
+        # Records not yet written to the journal. Each is a JSON string.
+        self._pending_records = []
+        self._journal_length = 0
+
+        if os.path.exists(self.filename) or \
+                os.path.exists(self.journal_filename):
             self.deserialize()
         else:
             self.graph = nx.DiGraph()
+            self._rebuild_index()
 
     def serialize(self):
-        with open(self.filename, "wt") as fh:
+        """
+        Append all changes since the last call to the journal.
+
+        Compacts the journal into a new snapshot if it grew too long.
+        """
+        if self._pending_records:
+            with open(self.journal_filename, "at") as fh:
+                fh.write("".join(_i + "\n" for _i in self._pending_records))
+                fh.flush()
+                os.fsync(fh.fileno())
+            self._journal_length += len(self._pending_records)
+            self._pending_records = []
+
+        if self._journal_length >= self.compaction_interval or \
+                not os.path.exists(self.filename):
+            self.compact()
+
+    def compact(self):
+        """
+        Write a new snapshot containing all changes and clear the journal.
+        """
+        self._pending_records = []
+        self.export(self.filename)
+        # A crash before this point just results in the journal being
+        # replayed on top of a snapshot that already contains it which is
+        # harmless.
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+        self._journal_length = 0
+
+    def export(self, filename):
+        """
+        Atomically write the full graph in the node-link JSON format.
+        """
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "wt") as fh:
             json.dump(self.get_json(), fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp_filename, filename)
 
     def deserialize(self):
-        with open(self.filename, "rt") as fh:
-            self.graph = networkx.readwrite.json_graph.node_link_graph(
-                json.load(fh))
+        if os.path.exists(self.filename):
+            with open(self.filename, "rt") as fh:
+                self.graph = networkx.readwrite.json_graph.node_link_graph(
+                    json.load(fh))
+        else:
+            self.graph = nx.DiGraph()
+
+        if os.path.exists(self.journal_filename):
+            with open(self.journal_filename, "rt") as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last record might be incomplete if the
+                        # process died while writing it.
+                        break
+                    self._replay(record)
+
+        self._rebuild_index()
+        self.compact()
+
+    def _replay(self, record):
+        """
+        Apply a single journal record to the (not yet indexed) graph.
+
+        Replaying a record more than once must not change the outcome.
+        """
+        op = record["op"]
+        job_id = record["job"]
+        if op == "add_job":
+            if job_id not in self.graph:
+                self.graph.add_node(job_id,
+                                    attr_dict=record["attributes"])
+            if record["from_node"]:
+                self.graph.add_edge(record["from_node"], job_id)
+        elif op == "replace":
+            self.graph.node[job_id] = record["attributes"]
+        elif op == "set":
+            self.graph.node[job_id][record["key"]] = record["value"]
+        elif op == "delete":
+            self.graph.node[job_id].pop(record["key"], None)
+        else:
+            raise NotImplementedError("Unknown journal operation '%s'." % op)
+
+    def _record(self, **record):
+        self._pending_records.append(json.dumps(record))
+
+    def _job_changed(self, job_id, key):
+        """
+        Called by the jobs after any of their attributes changed.
+        """
+        job = self.graph.node[job_id]
+        if key in job:
+            self._record(op="set", job=job_id, key=key, value=job[key])
+        else:
+            self._record(op="delete", job=job_id, key=key)
+
+        if key in _INDEXED_KEYS:
+            self._update_index(job_id)
 
     def get_json(self):
         return networkx.readwrite.json_graph.node_link_data(self.graph)
 
-    def add_job(self, task_type, inputs, priority=0, from_node=None):
+    def _rebuild_index(self):
+        """
+        Build the index of leaf jobs from scratch.
+        """
+        # Leaf job ids bucketed by their job status.
+        self._leaves_by_status = collections.defaultdict(set)
+        # Status of each leaf job.
+        self._leaf_status = {}
+        # Heap of runnable leaf jobs. Each entry is a list of
+        # [-critical, -priority, insertion count, job id, valid] so that
+        # jobs on the critical path come first, then the job with the
+        # highest priority and, for equal priorities, the earliest insertion.
+        # Entries are invalidated instead of removed.
+        self._heap = []
+        self._heap_entries = {}
+        self._counter = itertools.count()
+        # Insertion order of all jobs - the tie breaker for equal priorities.
+        self._order = {}
+
+        for job_id in self.graph.nodes_iter():
+            self._order[job_id] = next(self._counter)
+            self.graph.node[job_id] = _Job(self, job_id,
+                                           self.graph.node[job_id])
+            self._update_index(job_id)
+
+    def _remove_from_index(self, job_id):
+        if job_id in self._leaf_status:
+            status = self._leaf_status.pop(job_id)
+            self._leaves_by_status[status].discard(job_id)
+            if not self._leaves_by_status[status]:
+                del self._leaves_by_status[status]
+
+        entry = self._heap_entries.pop(job_id, None)
+        if entry is not None:
+            entry[-1] = False
+
+    def _update_index(self, job_id):
+        """
+        Update the index for a single job after it has been added or changed.
+        """
+        self._remove_from_index(job_id)
+
+        # Only leaves can be scheduled.
+        if self.graph.out_degree(job_id) != 0:
+            return
+
+        job = self.graph.node[job_id]
+        status = job.get("job_status")
+        self._leaf_status[job_id] = status
+        self._leaves_by_status[status].add(job_id)
+
+        # Running and successful jobs are never picked from the heap.
+        if status in ("running", "success"):
+            return
+
+        entry = [-int(job.get("critical", False)), -job.get("priority", 0),
+                 self._order[job_id], job_id, True]
+        self._heap_entries[job_id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def add_job(self, task_type, inputs, priority=0, from_node=None,
+                critical=False):
         now = datetime.datetime.now()
         graph_id = now.strftime("%y%m%dT%H%M%S_") + task_type + "_" + str(
             uuid.uuid4())
@@ -37,12 +277,23 @@ class FlowGraph():
             "task_type": task_type,
             "inputs": inputs,
             "priority": priority,
+            "critical": critical,
             "job_status": "not started"
         })
+        self._order[graph_id] = next(self._counter)
+        self.graph.node[graph_id] = _Job(self, graph_id,
+                                         self.graph.node[graph_id])
+        self._record(op="add_job", job=graph_id,
+                     attributes=self.graph.node[graph_id],
+                     from_node=from_node)
 
         if from_node:
             print("Adding edge from", from_node, "to", graph_id)
             self.graph.add_edge(from_node, graph_id)
+            # The parent is no longer a leaf.
+            self._update_index(from_node)
+
+        self._update_index(graph_id)
 
         return graph_id, self[graph_id]
 
@@ -50,40 +301,53 @@ class FlowGraph():
         """
         Get the current or next job.
         """
-        # Find all jobs that have no outwards pointing edges.
-        out_nodes = [i for i in self.graph.nodes_iter() if
-                     self.graph.out_degree(i) == 0]
-        if not out_nodes:
+        # Only jobs that have no outwards pointing edges are candidates.
+        if not self._leaf_status:
             raise NoJobsLeft
 
-        # Find the one that has status == running
-        running_nodes = [i for i in out_nodes
-                         if self.graph.node[i]["job_status"] == "running"]
+        # A running job is always the current one.
+        running_nodes = self._leaves_by_status.get("running", ())
         assert len(running_nodes) <= 1, "Only one job can be active at any " \
                                         "given time."
-        # One running node.
         if running_nodes:
-            return running_nodes[0]
-
-        # Make sure non of the out_nodes has a success state.
-        out_nodes = [i for i in out_nodes
-                     if self.graph.node[i]["job_status"] != "success"]
+            return next(iter(running_nodes))
 
-        # Now pick the job with the highest priority
-        out_nodes = sorted(out_nodes,
-                           key=lambda x: self.graph.node[x]["priority"],
-                           reverse=True)
+        # Otherwise the runnable job on the critical path with the highest
+        # priority. Discard invalidated entries on the way.
+        while self._heap and not self._heap[0][-1]:
+            heapq.heappop(self._heap)
 
-        if not out_nodes:
+        if not self._heap:
             raise NoJobsLeft
 
-        return out_nodes[0]
+        return self._heap[0][3]
+
+    def get_running_jobs(self):
+        """
+        Ids of all running jobs in insertion order.
+        """
+        return sorted(self._leaves_by_status.get("running", ()),
+                      key=lambda x: self._order[x])
+
+    def get_runnable_jobs(self):
+        """
+        Ids of all leaf jobs that are neither running nor successful in the
+        order they would be scheduled.
+        """
+        # Drop invalidated entries while at it.
+        self._heap = [_i for _i in self._heap if _i[-1]]
+        heapq.heapify(self._heap)
+        return [_i[3] for _i in sorted(self._heap)]
 
     def __getitem__(self, item):
         return self.graph.node[item]
 
     def __setitem__(self, item, value):
-        self.graph.node[item] = value
+        if item not in self._order:
+            self._order[item] = next(self._counter)
+        self.graph.node[item] = _Job(self, item, value)
+        self._record(op="replace", job=item, attributes=value)
+        self._update_index(item)
 
     def __len__(self):
-        return len(self.graph)
\ No newline at end of file
+        return len(self.graph)
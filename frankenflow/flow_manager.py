@@ -1,11 +1,14 @@
 import copy
 import os
 import shutil
+import threading
+import time
 
 from celery.result import AsyncResult
 
 from . import (celery_tasks, config, flow_graph, flow_status, utils, tasks,
-               NoJobsLeft, push_notifications)
+               NoJobsLeft, push_notifications, sqlite_flow_graph)
+from . import celery as celery_app
 
 
 class FlowManager():
@@ -46,6 +49,8 @@ class FlowManager():
                 os.path.join(output_folder, "ses3d_format_model_plots"),
             "ses3d_format_gradient_plots":
                 os.path.join(output_folder, "ses3d_format_gradient_plots"),
+            # Rendered plots keyed by the hash of their inputs.
+            "plot_cache": os.path.join(output_folder, "plot_cache"),
 
             # Collect all the misfits in simple text files.
             "misfits": os.path.join(output_folder, "misfits"),
@@ -64,71 +69,306 @@ class FlowManager():
 
         self.__check_data_files()
 
-        self.graph = flow_graph.FlowGraph(
-            filename=os.path.join(self.base_folder, "graph.json"))
+        self.scheduler = self.config.get("scheduler", "serial")
+        if self.scheduler not in ("serial", "concurrent"):
+            raise ValueError("Unknown scheduler '%s'. Must be either "
+                             "'serial' or 'concurrent'." % self.scheduler)
+
+        self.graph = self.__init_graph()
+
+        # The daemon and the web server might access the flow manager at the
+        # same time.
+        self._lock = threading.RLock()
+        # Set whenever a celery task finished to wake up the daemon.
+        self._wakeup = threading.Event()
+        # Jobs started during the current scheduling pass.
+        self._started_jobs = []
+
+    def __init_graph(self):
+        json_filename = os.path.join(self.base_folder, "graph.json")
+
+        backend = self.config.get("graph_backend", "json")
+        if backend == "json":
+            return flow_graph.FlowGraph(filename=json_filename)
+        elif backend == "sqlite":
+            filename = os.path.join(self.base_folder, "graph.sqlite")
+            # Migrate existing graphs.
+            if not os.path.exists(filename) and (
+                    os.path.exists(json_filename) or
+                    os.path.exists(os.path.splitext(json_filename)[0] +
+                                   ".journal")):
+                return sqlite_flow_graph.SQLiteFlowGraph.from_json(
+                    json_filename=json_filename, filename=filename)
+            return sqlite_flow_graph.SQLiteFlowGraph(filename=filename)
+        else:
+            raise ValueError("Unknown graph backend '%s'." % backend)
 
     @property
     def current_status(self):
-        return {
-            "status": self.status["current_status"],
-            "message": self.status["current_message"],
-            "goal": self.status["current_goal"]
-        }
+        with self._lock:
+            return {
+                "status": self.status["current_status"],
+                "message": self.status["current_message"],
+                "goal": self.status["current_goal"],
+                "critical_path_savings":
+                    self.status["critical_path_savings"]
+            }
+
+    def get_graph_json(self):
+        """
+        Copy of the JSON representation of the graph. The graph itself
+        might be changed by the daemon at the same time.
+        """
+        with self._lock:
+            return copy.deepcopy(self.graph.get_json())
 
-    def reset_job(self, job_id):
-        # Get the job.
-        job = copy.deepcopy(self.graph[job_id])
-
-        try:
-            del job["celery_task_id"]
-        except KeyError:
-            pass
-
-        try:
-            del job["run_information"]
-        except KeyError:
-            pass
-
-        # Reset files.
-        files = ["stdout", "stderr", "logfile"]
-        for filename in files:
-            if filename not in job:
-                continue
+    def _is_on_critical_path(self, task_type):
+        # Unknown tasks will fail once they are started - don't defer that.
+        if task_type not in tasks.task_map:
+            return True
+        return tasks.task_map[task_type].task_on_critical_path
+
+    def _update_runtime_estimate(self, task_type, run_information):
+        """
+        Keep a running mean of the runtime of each task type.
+        """
+        runtime = sum(value["runtime_stage"]
+                      for value in run_information.values()
+                      if isinstance(value, dict) and "runtime_stage" in value)
 
-            filename = job[filename]
+        runtimes = self.status["task_runtimes"] or {}
+        count, mean = runtimes.get(task_type, (0, 0.0))
+        count += 1
+        runtimes[task_type] = (count, mean + (runtime - mean) / count)
+        self.status["task_runtimes"] = runtimes
 
-            if not os.path.exists(filename):
+    def _account_deferred_jobs(self, started_jobs):
+        """
+        Record the time saved by starting jobs on the critical path before
+        side activities that would have been run first due to their higher
+        priority.
+
+        Called after each scheduling pass with the jobs started in it. Only
+        side activities that have been held back count, i.e. those that are
+        still not started. With the concurrent scheduler they must also
+        have been able to start if not for the critical jobs.
+
+        Each deferred job is only accounted for once. The savings are
+        estimated from the mean runtimes of previous jobs and are reported
+        per iteration.
+        """
+        critical_jobs = [
+            _i for _i in started_jobs
+            if self._is_on_critical_path(self.graph[_i]["task_type"])]
+        if not critical_jobs:
+            return
+
+        if self.scheduler == "concurrent":
+            running = [_i for _i in self.graph.get_running_jobs()
+                       if _i not in critical_jobs]
+            running_classes = [tasks.task_map[self.graph[_i]["task_type"]]
+                               for _i in running
+                               if not self.graph[_i].get("suspended")]
+            suspended_classes = [tasks.task_map[self.graph[_i]["task_type"]]
+                                 for _i in running
+                                 if self.graph[_i].get("suspended")]
+
+        runtimes = self.status["task_runtimes"] or {}
+        savings = self.status["critical_path_savings"] or {}
+        for job_id in critical_jobs:
+            job = self.graph[job_id]
+            iteration_name = job["inputs"].get("iteration_name")
+            if iteration_name is None:
                 continue
 
-            os.remove(filename)
+            saving = 0.0
+            deferred = []
+            for other_id in self.graph.get_runnable_jobs():
+                other = self.graph[other_id]
+                if other.get("critical", False) or \
+                        other.get("deferred_for_critical_path") or \
+                        other["job_status"] != "not started" or \
+                        other["priority"] <= job["priority"]:
+                    continue
+                # Held back by something else, e.g. another side activity
+                # occupying the same resources.
+                if self.scheduler == "concurrent" and not self._can_start(
+                        tasks.task_map[other["task_type"]], running_classes,
+                        suspended_classes):
+                    continue
+                other["deferred_for_critical_path"] = True
+                deferred.append(other_id)
+                saving += runtimes.get(other["task_type"], (0, 0.0))[1]
+
+            if deferred:
+                savings[iteration_name] = \
+                    savings.get(iteration_name, 0.0) + saving
+        self.status["critical_path_savings"] = savings
+
+    def reset_job(self, job_id):
+        with self._lock:
+            # Get the job.
+            job = copy.deepcopy(self.graph[job_id])
 
-        if "working_dir" in job:
-            wd = job["working_dir"]
-            if os.path.exists(wd):
-                shutil.rmtree(wd)
-            os.makedirs(wd, exist_ok=True)
+            try:
+                del job["celery_task_id"]
+            except KeyError:
+                pass
 
-        job["job_status"] = "not started"
+            try:
+                del job["run_information"]
+            except KeyError:
+                pass
 
-        self.graph[job_id] = job
-        self.graph.serialize()
+            # Reset files.
+            files = ["stdout", "stderr", "logfile"]
+            for filename in files:
+                if filename not in job:
+                    continue
+
+                filename = job[filename]
+
+                if not os.path.exists(filename):
+                    continue
+
+                os.remove(filename)
+
+            if "working_dir" in job:
+                wd = job["working_dir"]
+                if os.path.exists(wd):
+                    shutil.rmtree(wd)
+                os.makedirs(wd, exist_ok=True)
+
+            job["job_status"] = "not started"
+
+            self.graph[job_id] = job
+            self.graph.serialize()
+
+    def resume_job(self, job_id):
+        """
+        Restart an interrupted or failed job from its last checkpoint.
+
+        In contrast to reset_job() the working directory is kept so the job
+        continues with its first incomplete stage and reattaches to already
+        submitted remote runs.
+        """
+        with self._lock:
+            job = copy.deepcopy(self.graph[job_id])
+
+            # Make sure the old celery task does not come back. A task that
+            # is still running is terminated as it would otherwise continue
+            # in the same working directory.
+            if "celery_task_id" in job:
+                celery_app.control.revoke(job["celery_task_id"],
+                                          terminate=True)
+                self._wait_for_task_to_stop(
+                    job_id, AsyncResult(id=job["celery_task_id"]))
+                del job["celery_task_id"]
+
+            for key in ["run_information", "suspended"]:
+                try:
+                    del job[key]
+                except KeyError:
+                    pass
+
+            job["job_status"] = "not started"
+
+            self.graph[job_id] = job
+            self.graph.serialize()
+
+    def _wait_for_task_to_stop(self, job_id, result, timeout=60.0):
+        start = time.time()
+        while result.state in ("STARTED", "RESUMED"):
+            if time.time() - start > timeout:
+                raise ValueError(
+                    "Job '%s' is still running and could not be stopped. "
+                    "Not resuming it." % job_id)
+            time.sleep(1.0)
 
     def iterate(self):
         """
         Attempt to advance the workflow a single step.
 
-        Should be periodically called by something.
+        Should be periodically called by something - either the daemon or
+        the /iterate endpoint of the server.
         """
-        try:
-            self._iterate()
-        except Exception:
-            tb = utils.collect_traceback(3)
-            self.status["current_message"] = tb
-            self.status["current_status"] = "ERROR"
+        # All status changes of a single iteration are written at once.
+        with self._lock, self.status.transaction():
+            try:
+                self._iterate()
+            except Exception:
+                tb = utils.collect_traceback(3)
+                self.status["current_message"] = tb
+                self.status["current_status"] = "ERROR"
+
+                push_notifications.send_notification(
+                    title="Workflow encountered error.",
+                    message="Problem with main iterate function: %s" % tb)
 
-            push_notifications.send_notification(
-                title="Workflow encountered error.",
-                message="Problem with main iterate function: %s" % tb)
+    def _progress_marker(self):
+        return (len(self.graph), tuple(self.graph.get_running_jobs()),
+                tuple(self.graph.get_runnable_jobs()))
+
+    def iterate_until_blocked(self, max_steps=100):
+        """
+        Advance the workflow until it cannot advance any further, i.e.
+        until an iteration does not change anything anymore.
+
+        Returns the number of iterations.
+        """
+        with self._lock:
+            for step in range(1, max_steps + 1):
+                before = self._progress_marker()
+                self.iterate()
+                if self.status["current_status"] in ("ERROR", "DONE") or \
+                        self._progress_marker() == before:
+                    break
+        return step
+
+    def start_daemon(self, poll_interval=60.0):
+        """
+        Start a background thread advancing the workflow.
+
+        The workflow is advanced as soon as celery reports a finished task
+        and additionally every ``poll_interval`` seconds in case an event
+        got lost. The celery workers must send task events which is enabled
+        in the celery configuration.
+        """
+        listener = threading.Thread(target=self._listen_to_celery_events,
+                                    name="frankenflow-events", daemon=True)
+        listener.start()
+
+        daemon = threading.Thread(target=self._daemon_loop,
+                                  args=(poll_interval,),
+                                  name="frankenflow-daemon", daemon=True)
+        daemon.start()
+
+    def _daemon_loop(self, poll_interval):
+        while True:
+            self._wakeup.wait(poll_interval)
+            self._wakeup.clear()
+            self.iterate_until_blocked()
+
+    def _listen_to_celery_events(self):
+        def on_task_finished(event):
+            self._wakeup.set()
+
+        handlers = {
+            "task-succeeded": on_task_finished,
+            "task-failed": on_task_finished,
+            "task-revoked": on_task_finished
+        }
+
+        while True:
+            try:
+                with celery_app.connection() as connection:
+                    receiver = celery_app.events.Receiver(
+                        connection, handlers=handlers)
+                    receiver.capture(limit=None, timeout=None, wakeup=True)
+            except Exception as e:
+                print("Lost connection to the celery event stream: %s. "
+                      "Reconnecting in 10 seconds." % str(e))
+                time.sleep(10)
 
     def _iterate(self):
         # If there is no job, create one!
@@ -137,18 +377,110 @@ class FlowManager():
 
         assert len(self.graph) != 0, "The graph must not be empty!"
 
-        try:
-            job_id = self.graph.get_current_or_next_job()
-        except NoJobsLeft:
-            self.status["current_status"] = "DONE"
-            self.status["current_message"] = "No jobs left"
+        self._started_jobs = []
+        if self.scheduler == "concurrent":
+            self._iterate_concurrently()
+        else:
+            try:
+                job_id = self.graph.get_current_or_next_job()
+            except NoJobsLeft:
+                self._set_done()
+                return
+            self.advance_job(job_id)
+        self._account_deferred_jobs(self._started_jobs)
+
+    def _set_done(self):
+        self.status["current_status"] = "DONE"
+        self.status["current_message"] = "No jobs left"
+
+        push_notifications.send_notification(
+            title="Workflow done.",
+            message="No more jobs left")
+
+    @property
+    def resource_limits(self):
+        """
+        Maximum number of concurrently running jobs per resource.
+
+        Resources not given in the config file have a limit of one.
+        """
+        limits = {"ssh": 1, "local_cpu": 1, "plotting": 1}
+        limits.update(self.config.get("resource_limits", {}))
+        return limits
+
+    def _can_start(self, job_class, running_classes, suspended_classes=()):
+        """
+        Check if a job of the given class can start while jobs of the given
+        classes are running. Suspended jobs don't occupy any resources.
+        """
+        # Never run jobs requiring a goal concurrently to jobs that might
+        # change the goal.
+        all_classes = list(running_classes) + list(suspended_classes)
+        if job_class.task_requires_active_goal and \
+                any(_i.task_may_set_new_goal for _i in all_classes):
+            return False
+        if job_class.task_may_set_new_goal and \
+                any(_i.task_requires_active_goal or _i.task_may_set_new_goal
+                    for _i in all_classes):
+            return False
+
+        limits = self.resource_limits
+        for resource, count in job_class.task_resources.items():
+            used = sum(_i.task_resources.get(resource, 0)
+                       for _i in running_classes)
+            if used + count > limits.get(resource, 1):
+                return False
+        return True
+
+    def _iterate_concurrently(self):
+        """
+        Advance all running jobs and launch every runnable job as long as
+        the resource limits allow it.
+        """
+        # Check all running jobs first - finished ones free their resources
+        # and might generate new jobs.
+        for job_id in self.graph.get_running_jobs():
+            self.advance_job(job_id)
+
+        running = self.graph.get_running_jobs()
+        runnable = self.graph.get_runnable_jobs()
 
-            push_notifications.send_notification(
-                title="Workflow done.",
-                message="No more jobs left")
+        if not running and not runnable:
+            self._set_done()
+            return
 
+        # Failed jobs require to be restarted. Don't launch anything else
+        # until that happened.
+        if any(self.graph[_i]["job_status"] == "failed" for _i in runnable):
             return
-        self.advance_job(job_id)
+
+        running_classes = [tasks.task_map[self.graph[_i]["task_type"]]
+                           for _i in running
+                           if not self.graph[_i].get("suspended")]
+        suspended_classes = [tasks.task_map[self.graph[_i]["task_type"]]
+                             for _i in running
+                             if self.graph[_i].get("suspended")]
+
+        for job_id in runnable:
+            job = self.graph[job_id]
+            # Manually finished jobs and the like don't require any resources.
+            if job["job_status"] != "not started":
+                self.advance_job(job_id)
+                continue
+
+            job_class = tasks.task_map[job["task_type"]]
+            if not self._can_start(job_class, running_classes,
+                                   suspended_classes):
+                continue
+
+            self.start_job(job_id)
+            running.append(job_id)
+            running_classes.append(job_class)
+
+        self.status["current_status"] = "OK"
+        self.status["current_message"] = \
+            "%i job(s) currently running: %s" % (
+                len(running), ", ".join("'%s'" % _i for _i in running))
 
     def advance_job(self, job_id):
         job = self.graph[job_id]
@@ -157,7 +489,10 @@ class FlowManager():
         # one wants to manually finish a job.
         #
         # If that is done, the graph.json file has to be manually edit and
-        # two things have to be done for the current job:
+        # two things have to be done for the current job. Stop the server
+        # before editing. Changes are journaled and only compacted into
+        # graph.json when the graph is loaded so start and stop the server
+        # once before editing to get an up-to-date file:
         #
         # 1. Set the "job_status" to "manually_finished"
         # 2. Add a new "manually_set_next_steps" item and manually add the
@@ -183,7 +518,8 @@ class FlowManager():
                     task_type=step["task_type"],
                     inputs=inputs,
                     priority=prio,
-                    from_node=job_id)
+                    from_node=job_id,
+                    critical=self._is_on_critical_path(step["task_type"]))
 
             self.graph.serialize()
             return
@@ -192,20 +528,43 @@ class FlowManager():
             # Check if it is still running.
             result = AsyncResult(id=job["celery_task_id"])
             print("STATE:", result.state)
-            # Still running. Nothing to be done.
-            if result.state == "SENT":
+            # Still queued or running. Nothing to be done.
+            if result.state in ("SENT", "STARTED", "RESUMED"):
                 self.status["current_status"] = "OK"
-                self.status["current_message"] = \
-                    "Job '%s' currently running." % job_id
+                # The wait condition of a suspended job holds and it
+                # continues - it occupies its resources again.
+                if result.state == "RESUMED" and job.get("suspended"):
+                    job.pop("suspended")
+                    self.graph.serialize()
+                if job.get("suspended"):
+                    self.status["current_message"] = \
+                        "Job '%s' is waiting for its run to finish." % job_id
+                else:
+                    self.status["current_message"] = \
+                        "Job '%s' currently running." % job_id
             # Run finished. A run should not really fail.
             elif result.state == "SUCCESS":
                 return_value = result.wait()
                 job["run_information"] = return_value
+                # The job suspended itself and a new celery task will resume
+                # it. It keeps running but does not occupy a worker.
+                if return_value["status"] == "waiting":
+                    job["celery_task_id"] = return_value["resume_task_id"]
+                    job["suspended"] = True
+                    self.status["current_status"] = "OK"
+                    self.status["current_message"] = \
+                        "Job '%s' is waiting for its run to finish." % job_id
+                    self.graph.serialize()
+                    return
+                job.pop("suspended", None)
+
                 if return_value["status"] == "success":
                     job["job_status"] = "success"
                     self.status["current_message"] = \
                         "Successfully completed job '%s'." % (job_id)
                     self.status["current_status"] = "SUCCESS"
+                    self._update_runtime_estimate(job["task_type"],
+                                                  return_value)
 
                     if return_value["next_steps"]:
                         for step in return_value["next_steps"]:
@@ -226,7 +585,9 @@ class FlowManager():
                                 task_type=step["task_type"],
                                 inputs=inputs,
                                 priority=prio,
-                                from_node=job_id)
+                                from_node=job_id,
+                                critical=self._is_on_critical_path(
+                                    step["task_type"]))
 
                     if "new_goal" in return_value:
                         self.status["current_goal"] = return_value["new_goal"]
@@ -312,6 +673,7 @@ class FlowManager():
                                                context=self.info)
         self.graph[job_id]["job_status"] = "running"
         self.graph[job_id]["celery_task_id"] = result.task_id
+        self._started_jobs.append(job_id)
 
         keys = ["working_dir", "stdout", "stderr", "logfile"]
         for key in keys:
@@ -332,7 +694,8 @@ class FlowManager():
         self.graph.add_job(
             task_type="Orchestrate",
             inputs={},
-            from_node=job_id
+            from_node=job_id,
+            critical=True
         )
 
         self.graph.serialize()
@@ -1,3 +1,4 @@
+import contextlib
 import json
 import os
 
@@ -7,23 +8,65 @@ class FlowStatus(object):
     Simple persistent status.
 
     Like a dictionary just always stored on disc.
+
+    An in-memory copy is kept and only re-read if the file changed on disc.
+    Every assignment is written to disc immediately unless it happens
+    within a transaction in which case all changes are written at once at
+    its end. Writes are atomic.
     """
     def __init__(self, filename):
         self._filename = filename
+        self._transaction_depth = 0
+        self._dirty = False
         self._deserialize()
 
     def __getitem__(self, item):
-        if item not in self.__status:
-            return None
-        self._deserialize()
-        return self.__status[item]
+        self._refresh()
+        return self.__status.get(item)
 
     def __setitem__(self, key, value):
+        self._refresh()
         self.__status[key] = value
-        self._serialize()
+        if self._transaction_depth:
+            self._dirty = True
+        else:
+            self._serialize()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Coalesce all changes within the context into a single write.
+
+        Transactions can be nested - the changes are written once the
+        outermost one ends.
+        """
+        self._refresh()
+        self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            self._transaction_depth -= 1
+            if not self._transaction_depth and self._dirty:
+                self._dirty = False
+                self._serialize()
+
+    def _get_file_signature(self):
+        try:
+            stat = os.stat(self._filename)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        # Within a transaction the in-memory copy is the truth.
+        if self._transaction_depth:
+            return
+        if self._get_file_signature() != self._file_signature:
+            self._deserialize()
 
     def _deserialize(self):
-        if not os.path.exists(self._filename):
+        self._file_signature = self._get_file_signature()
+        if self._file_signature is None:
             self.__status = {}
         else:
             with open(self._filename, "rt") as fh:
@@ -31,5 +74,8 @@ class FlowStatus(object):
         return self.__status
 
     def _serialize(self):
-        with open(self._filename, "wt") as fh:
-            json.dump(self.__status, fh)
\ No newline at end of file
+        temp_filename = self._filename + ".tmp"
+        with open(temp_filename, "wt") as fh:
+            json.dump(self.__status, fh)
+        os.replace(temp_filename, self._filename)
+        self._file_signature = self._get_file_signature()
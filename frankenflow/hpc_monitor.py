@@ -0,0 +1,116 @@
+import contextlib
+import fcntl
+import json
+import os
+import time
+
+
+def parse_agere_status(lines):
+    """
+    Parse the table printed by `agere status`.
+
+    Returns a dictionary job number -> {"status": ..., "columns": [...]}
+    with the status in upper case and all further columns of the table.
+    """
+    jobs = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("JOB NUMBER") or \
+                line.startswith("====="):
+            continue
+        columns = line.split()
+        jobs[columns[0]] = {"status": columns[1].upper(),
+                            "columns": columns[1:]}
+    return jobs
+
+
+class HPCJobMonitor():
+    """
+    Monitor for all agere runs on the HPC.
+
+    The parsed output of `agere status` is cached in a file shared by all
+    workers. No matter how many jobs are waiting for their runs, the HPC is
+    only queried again once the cache is older than what the most impatient
+    job is willing to accept. The waiting jobs themselves just read the
+    cache.
+
+    :param cache_filename: The shared cache file.
+    :param query_function: Function running `agere status` on the HPC and
+        returning the lines of its stdout.
+    :param min_interval: Minimum interval between two status checks of a
+        job in seconds.
+    :param max_interval: Maximum interval between two status checks of a
+        job in seconds.
+    """
+    def __init__(self, cache_filename, query_function, min_interval=10.0,
+                 max_interval=600.0):
+        self.cache_filename = cache_filename
+        self.query_function = query_function
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.cache_filename + ".lock", "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _read_cache(self, max_age, not_before):
+        try:
+            with open(self.cache_filename, "rt") as fh:
+                cache = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - cache["time"] > max_age or \
+                cache["time"] < not_before:
+            return None
+        return cache["jobs"]
+
+    def get_statuses(self, max_age, not_before=0.0):
+        """
+        Parsed status of all runs, at most ``max_age`` seconds old and not
+        queried before the timestamp ``not_before``.
+        """
+        jobs = self._read_cache(max_age, not_before)
+        if jobs is not None:
+            return jobs
+
+        with self._locked():
+            # Someone else might have just queried it.
+            jobs = self._read_cache(max_age, not_before)
+            if jobs is not None:
+                return jobs
+
+            jobs = parse_agere_status(self.query_function())
+
+            temp_filename = self.cache_filename + ".tmp"
+            with open(temp_filename, "wt") as fh:
+                json.dump({"time": time.time(), "jobs": jobs}, fh)
+            os.replace(temp_filename, self.cache_filename)
+
+        return jobs
+
+    def get_status(self, job_id, max_age, not_before=0.0):
+        """
+        Status of a single run, at most ``max_age`` seconds old and not
+        queried before the timestamp ``not_before``.
+        """
+        jobs = self.get_statuses(max_age=max_age, not_before=not_before)
+        if job_id not in jobs:
+            raise ValueError("`agere_status` did not contain run '%s'" %
+                             job_id)
+        return jobs[job_id]["status"]
+
+    def get_poll_interval(self, expected_end_time):
+        """
+        Interval until a run expected to finish at the given time should be
+        checked again.
+
+        Runs far from their expected end are checked rarely, runs that
+        should be finishing soon or are overdue are checked often.
+        """
+        remaining = expected_end_time - time.time()
+        return max(self.min_interval, min(self.max_interval, remaining / 10.0))
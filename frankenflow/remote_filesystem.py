@@ -0,0 +1,117 @@
+import collections
+import os
+import shlex
+import stat
+import time
+
+
+RemoteStat = collections.namedtuple("RemoteStat", ["size", "mtime", "is_dir"])
+
+
+def _to_remote_stat(attributes):
+    return RemoteStat(size=attributes.st_size, mtime=attributes.st_mtime,
+                      is_dir=stat.S_ISDIR(attributes.st_mode))
+
+
+class RemoteFileSystem():
+    """
+    Metadata of the remote file system with a time limited cache.
+
+    Directory listings include size and modification time of all entries
+    and are cached for ``ttl`` seconds so repeated listings of the same
+    directory and existence checks of files in it don't require another
+    round trip. Anything that might modify the remote file system must call
+    invalidate().
+    """
+    def __init__(self, ssh_client, sftp_client, ttl=60.0):
+        self.ssh_client = ssh_client
+        self.sftp_client = sftp_client
+        self.ttl = ttl
+        # Path -> (time of the listing, {name: RemoteStat}).
+        self._listings = {}
+
+    def invalidate(self, path=None):
+        """
+        Invalidate the cached listing of a directory or everything.
+        """
+        if path is None:
+            self._listings = {}
+        else:
+            self._listings.pop(os.path.normpath(path), None)
+
+    def _cached_listing(self, path):
+        path = os.path.normpath(path)
+        if path not in self._listings:
+            return None
+        timestamp, listing = self._listings[path]
+        if time.time() - timestamp > self.ttl:
+            del self._listings[path]
+            return None
+        return listing
+
+    def listdir_attr(self, path):
+        """
+        Name -> RemoteStat for all entries of the remote directory.
+
+        Raises a FileNotFoundError if it does not exist.
+        """
+        listing = self._cached_listing(path)
+        if listing is None:
+            listing = {_i.filename: _to_remote_stat(_i)
+                       for _i in self.sftp_client.listdir_attr(path=path)}
+            self._listings[os.path.normpath(path)] = (time.time(), listing)
+        return listing
+
+    def listdir(self, path):
+        return list(self.listdir_attr(path).keys())
+
+    def stat(self, path):
+        """
+        RemoteStat of the path or None if it does not exist.
+        """
+        return self.stat_many([path])[path]
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def stat_many(self, paths):
+        """
+        Stat many remote paths at once.
+
+        Returns a dictionary path -> RemoteStat or None if the path does not
+        exist. Paths in directories with cached listings are answered from
+        the cache, all others are determined with a single remote command.
+        """
+        results = {}
+        missing = []
+        for path in paths:
+            listing = self._cached_listing(os.path.dirname(
+                os.path.normpath(path)))
+            if listing is None:
+                missing.append(path)
+            else:
+                results[path] = listing.get(os.path.basename(
+                    os.path.normpath(path)))
+
+        if not missing:
+            return results
+
+        # Size, modification time, raw mode in hex, and name - non-existing
+        # files only produce an error message.
+        cmd = "stat -c '%%s %%Y %%f %%n' -- %s" % " ".join(
+            shlex.quote(_i) for _i in missing)
+        _, stdout, _ = self.ssh_client.exec_command(cmd)
+
+        stats = {}
+        for line in stdout.readlines():
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            size, mtime, mode, name = line.split(" ", 3)
+            stats[name] = RemoteStat(
+                size=int(size), mtime=int(mtime),
+                is_dir=stat.S_ISDIR(int(mode, 16)))
+
+        for path in missing:
+            results[path] = stats.get(path)
+        return results
@@ -61,9 +61,15 @@ def reset_job(job_id):
     return ""
 
 
+@app.route("/resume/<job_id>")
+def resume_job(job_id):
+    app.flow_manager.resume_job(job_id)
+    return ""
+
+
 @app.route("/graph")
 def graph():
-    json_graph = app.flow_manager.graph.get_json()
+    json_graph = app.flow_manager.get_graph_json()
 
     # Rewrite so it can be easily plotted with vis.js.
     json_graph["edges"] = []
@@ -145,6 +151,12 @@ def __main__():
     parser.add_argument("--debug", action="store_true", help="debug mode")
     parser.add_argument("--open_to_outside", action="store_true",
                         help="access server from other computers")
+    parser.add_argument("--no_daemon", action="store_true",
+                        help="do not advance the workflow automatically - "
+                             "it then has to be triggered with /iterate")
+    parser.add_argument("--poll_interval", default=60.0, type=float,
+                        help="seconds between iterations of the daemon if no "
+                             "celery task finished in the meanwhile")
     parser.add_argument("folder",
                         help="folder containing the frankenflow project")
 
@@ -157,6 +169,11 @@ def __main__():
         raise ValueError("'%s' is not a folder." % args.folder)
 
     fm = FlowManager(os.path.abspath(args.folder))
+    # The reloader of the debug mode runs this script twice - the daemon
+    # must only run in the process actually serving the requests.
+    if not args.no_daemon and (not args.debug or
+                               os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+        fm.start_daemon(poll_interval=args.poll_interval)
     serve(flow_manager=fm, port=args.port, debug=args.debug,
           open_to_outside=args.open_to_outside)
 
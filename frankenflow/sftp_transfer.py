@@ -0,0 +1,232 @@
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+
+from . import shuffle_codec
+
+
+def format_size(size):
+    """
+    Human readable size of a number of bytes.
+    """
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024.0:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % size
+
+
+class _Progress():
+    """
+    Logs the progress of a single file in steps of 25 percent.
+    """
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+        self.next_step = 25
+
+    def __call__(self, transferred, total):
+        if not total:
+            return
+        percent = 100.0 * transferred / total
+        if percent < self.next_step or percent >= 100:
+            return
+        while self.next_step <= percent:
+            self.next_step += 25
+        self.log("%s: %i%% of %s" % (self.name, int(percent),
+                                     format_size(total)))
+
+
+def _put_encoded(client, localpath, remotepath, callback):
+    """
+    Upload a file encoded with the shuffle codec on the fly. Returns the
+    number of sent bytes.
+    """
+    size = os.path.getsize(localpath)
+    sent = 0
+    with open(localpath, "rb") as fh, \
+            client.open(remotepath, "wb") as remote_fh:
+        remote_fh.set_pipelined(True)
+        for data in shuffle_codec.encode_stream(fh):
+            remote_fh.write(data)
+            sent += len(data)
+            callback(min(fh.tell(), size), size)
+    return sent
+
+
+def upload_files(ssh_client, sftp_client, files, parallel=4, log=None,
+                 codec="none"):
+    """
+    Upload many files over several SFTP channels of one SSH connection.
+
+    A single SFTP channel is limited by its window and the latency so
+    large transfers are spread over ``parallel`` channels, each uploading
+    one file at a time with pipelined writes. With ``parallel=1`` all
+    files are uploaded one after another over ``sftp_client`` which is
+    mainly useful for debugging.
+
+    :param ssh_client: Connected SSH client used to open more channels.
+    :param sftp_client: Already open SFTP client which is used by the
+        first worker.
+    :param files: List of (local path, remote path) tuples.
+    :param parallel: Number of concurrently used SFTP channels.
+    :param log: Optional function called with progress messages. It is
+        called from multiple threads.
+    :param codec: "none" or "shuffle" to encode each file with the
+        shuffle codec on the fly. The remote files then have to be decoded.
+
+    Returns the total number of bytes, the number of actually sent bytes,
+    and the time it took in seconds.
+    """
+    lock = threading.Lock()
+
+    def _log(msg):
+        if log is None:
+            return
+        with lock:
+            log(msg)
+
+    sizes = {_i[0]: os.path.getsize(_i[0]) for _i in files}
+    total_size = sum(sizes.values())
+    count = len(files)
+    done = []
+    sent = []
+
+    def _upload(client, localpath, remotepath):
+        name = os.path.basename(localpath)
+        start = time.time()
+        if codec == "shuffle":
+            sent_bytes = _put_encoded(client, localpath, remotepath,
+                                      callback=_Progress(name, _log))
+        else:
+            client.put(localpath=localpath, remotepath=remotepath,
+                       callback=_Progress(name, _log))
+            sent_bytes = sizes[localpath]
+        runtime = time.time() - start
+        with lock:
+            done.append(localpath)
+            sent.append(sent_bytes)
+            finished = len(done)
+        _log("Uploaded %s (%s in %.1f s, %s/s) [%i/%i]" % (
+            name, format_size(sizes[localpath]), runtime,
+            format_size(sizes[localpath] / max(runtime, 1E-6)),
+            finished, count))
+
+    _log("Uploading %i files (%s) with %i parallel SFTP channel(s)." % (
+        count, format_size(total_size), parallel))
+    start = time.time()
+
+    if parallel <= 1:
+        for localpath, remotepath in files:
+            _upload(sftp_client, localpath, remotepath)
+    else:
+        # Largest files first so the channels finish at roughly the same
+        # time.
+        todo = queue.Queue()
+        for item in sorted(files, key=lambda x: sizes[x[0]], reverse=True):
+            todo.put(item)
+
+        def _worker(index):
+            # Each worker uses its own channel.
+            if index == 0:
+                client = sftp_client
+            else:
+                client = ssh_client.open_sftp()
+            try:
+                while True:
+                    try:
+                        localpath, remotepath = todo.get_nowait()
+                    except queue.Empty:
+                        return
+                    _upload(client, localpath, remotepath)
+            finally:
+                if client is not sftp_client:
+                    client.close()
+
+        with concurrent.futures.ThreadPoolExecutor(parallel) as executor:
+            futures = [executor.submit(_worker, _i)
+                       for _i in range(min(parallel, count))]
+            # Raises the first exception if any.
+            for future in futures:
+                future.result()
+
+    runtime = time.time() - start
+    _log("Uploaded %s in %.1f seconds (%s/s)." % (
+        format_size(total_size), runtime,
+        format_size(total_size / max(runtime, 1E-6))))
+    if codec != "none":
+        _log("Codec '%s' sent %s - a compression ratio of %.2f." % (
+            codec, format_size(sum(sent)),
+            total_size / max(sum(sent), 1)))
+    return total_size, sum(sent), runtime
+
+
+def download_file(sftp_client, remotepath, localpath, checksum,
+                  chunk_size=8 * 1024 * 1024, log=None):
+    """
+    Download a single file or continue a partial download.
+
+    Data is appended to the local file starting at its current size and
+    every appended chunk is fed to ``checksum`` so the file never has to be
+    read again to verify it. Each chunk is written and fed to the checksum
+    at the same time so both always match and an interrupted download can
+    be continued at the size of the local file. The local file is synced to
+    disc every 64 chunks.
+
+    :param sftp_client: The SFTP client.
+    :param remotepath: The remote file.
+    :param localpath: The local file. Might exist and contain the first
+        bytes of the remote file.
+    :param checksum: A hashlib object that already contains the data of
+        the local file.
+    :param chunk_size: Size of the chunks in bytes.
+    :param log: Optional function called with progress messages.
+
+    Returns the number of transferred bytes.
+    """
+    offset = os.path.getsize(localpath) if os.path.exists(localpath) else 0
+    size = sftp_client.stat(remotepath).st_size
+    assert offset <= size, \
+        "Local file '%s' is larger than the remote file." % localpath
+
+    if log is not None:
+        log("Downloading %s of %s starting at byte %i." % (
+            format_size(size - offset), remotepath, offset))
+
+    start = time.time()
+    last_log = start
+    transferred = 0
+    with sftp_client.open(remotepath, "rb") as remote_fh, \
+            open(localpath, "ab") as local_fh:
+        remote_fh.seek(offset)
+        # Pipelines the read requests for the rest of the file.
+        remote_fh.prefetch(size)
+
+        chunks = 0
+        while True:
+            data = remote_fh.read(chunk_size)
+            if not data:
+                break
+            local_fh.write(data)
+            checksum.update(data)
+            transferred += len(data)
+
+            chunks += 1
+            if not chunks % 64:
+                local_fh.flush()
+                os.fsync(local_fh.fileno())
+
+            if log is not None and time.time() - last_log > 60:
+                last_log = time.time()
+                log("Downloaded %s of %s (%s/s)" % (
+                    format_size(offset + transferred), format_size(size),
+                    format_size(transferred / (last_log - start))))
+
+    runtime = time.time() - start
+    if log is not None:
+        log("Downloaded %s in %.1f seconds (%s/s)." % (
+            format_size(transferred), runtime,
+            format_size(transferred / max(runtime, 1E-6))))
+    return transferred
@@ -0,0 +1,136 @@
+"""
+Lossless compression of files of 4 byte floats for transfers to and from
+the HPC.
+
+The bytes of all values are shuffled so all first bytes come first, then
+all second bytes, and so on before compressing them with zlib. Exponents
+and high mantissa bytes of neighbouring values are very similar so this
+compresses much better than the raw values.
+
+Only depends on the standard library as it is also copied to and run on
+the HPC:
+
+    python shuffle_codec.py encode FILE > ENCODED
+    python shuffle_codec.py decode ENCODED FILE [ENCODED FILE ...]
+"""
+import struct
+import sys
+import zlib
+
+
+MAGIC = b"FFSHUF1\n"
+# Compressed length and raw length of each chunk.
+_HEADER = struct.Struct("<QQ")
+# Must be a multiple of the item size.
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def shuffle(data, itemsize=4):
+    """
+    Byte-shuffle the data. Trailing bytes not forming a full item are
+    appended unchanged.
+    """
+    data = memoryview(data).cast("B")
+    n = len(data) - len(data) % itemsize
+    parts = [data[_i:n:itemsize].tobytes() for _i in range(itemsize)]
+    parts.append(data[n:].tobytes())
+    return b"".join(parts)
+
+
+def unshuffle(data, itemsize=4):
+    """
+    Inverse of shuffle().
+    """
+    data = memoryview(data).cast("B")
+    n = len(data) - len(data) % itemsize
+    count = n // itemsize
+    out = bytearray(len(data))
+    for _i in range(itemsize):
+        out[_i:n:itemsize] = data[_i * count:(_i + 1) * count]
+    out[n:] = data[n:]
+    return bytes(out)
+
+
+def encode_stream(fh, chunk_size=CHUNK_SIZE, level=6):
+    """
+    Generator encoding the content of the binary file object.
+    """
+    yield MAGIC
+    while True:
+        raw = fh.read(chunk_size)
+        if not raw:
+            break
+        compressed = zlib.compress(shuffle(raw), level)
+        yield _HEADER.pack(len(compressed), len(raw))
+        yield compressed
+
+
+class Decoder():
+    """
+    Incrementally decodes the output of encode_stream().
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._magic_checked = False
+
+    def feed(self, data):
+        """
+        Feed some encoded data and return all data that could be decoded.
+        """
+        self._buffer.extend(data)
+        if not self._magic_checked:
+            if len(self._buffer) < len(MAGIC):
+                return b""
+            if bytes(self._buffer[:len(MAGIC)]) != MAGIC:
+                raise ValueError("Not a shuffle codec stream.")
+            del self._buffer[:len(MAGIC)]
+            self._magic_checked = True
+
+        output = []
+        while len(self._buffer) >= _HEADER.size:
+            compressed_size, raw_size = _HEADER.unpack_from(self._buffer)
+            end = _HEADER.size + compressed_size
+            if len(self._buffer) < end:
+                break
+            raw = unshuffle(zlib.decompress(
+                bytes(self._buffer[_HEADER.size:end])))
+            if len(raw) != raw_size:
+                raise ValueError("Corrupt shuffle codec stream.")
+            output.append(raw)
+            del self._buffer[:end]
+        return b"".join(output)
+
+    def finish(self):
+        """
+        Make sure the stream ended after a complete chunk.
+        """
+        if not self._magic_checked or self._buffer:
+            raise ValueError("Incomplete shuffle codec stream.")
+
+
+def decode_file(src, dest, chunk_size=CHUNK_SIZE):
+    decoder = Decoder()
+    with open(src, "rb") as src_fh, open(dest, "wb") as dest_fh:
+        while True:
+            data = src_fh.read(chunk_size)
+            if not data:
+                break
+            dest_fh.write(decoder.feed(data))
+    decoder.finish()
+
+
+def main(argv):
+    if len(argv) == 2 and argv[0] == "encode":
+        with open(argv[1], "rb") as fh:
+            for data in encode_stream(fh):
+                sys.stdout.buffer.write(data)
+    elif len(argv) >= 3 and len(argv) % 2 and argv[0] == "decode":
+        for src, dest in zip(argv[1::2], argv[2::2]):
+            decode_file(src, dest)
+    else:
+        sys.exit("Usage: shuffle_codec.py encode FILE | "
+                 "decode SRC DEST [SRC DEST ...]")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
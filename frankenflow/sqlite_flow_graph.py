@@ -0,0 +1,245 @@
+import datetime
+import json
+import os
+import sqlite3
+import uuid
+
+import networkx as nx
+import networkx.readwrite.json_graph
+
+from . import NoJobsLeft
+from .flow_graph import FlowGraph, _Job
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    -- Insertion order - the tie breaker for equal priorities.
+    seq INTEGER NOT NULL,
+    job_status TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    critical INTEGER NOT NULL DEFAULT 0,
+    is_leaf INTEGER NOT NULL DEFAULT 1,
+    -- All other attributes as JSON.
+    attributes TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS edges (
+    source TEXT NOT NULL,
+    target TEXT NOT NULL,
+    PRIMARY KEY (source, target)
+);
+CREATE TABLE IF NOT EXISTS run_information (
+    job_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_leaf_status ON jobs (is_leaf, job_status);
+CREATE INDEX IF NOT EXISTS jobs_leaf_priority
+    ON jobs (is_leaf, critical DESC, priority DESC, seq);
+CREATE INDEX IF NOT EXISTS edges_target ON edges (target);
+"""
+
+
+class SQLiteFlowGraph():
+    """
+    Execution graph of the workflow stored in an SQLite database.
+
+    Drop-in replacement for the FlowGraph. Jobs are only loaded when they
+    are requested and finding the next job is a single indexed query so
+    nothing has to be loaded when the flow manager starts. Jobs can be
+    modified in-place exactly like the jobs of the FlowGraph. Changes are
+    committed with serialize().
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript(_SCHEMA)
+        self.connection.commit()
+        # Jobs that have been loaded so far. Each job id always maps to the
+        # same object, just like for the networkx graph.
+        self._jobs = {}
+
+    @classmethod
+    def from_json(cls, json_filename, filename):
+        """
+        Migrate an existing graph.json (including its journal) to a new
+        SQLite database.
+        """
+        assert not os.path.exists(filename), \
+            "'%s' already exists." % filename
+
+        graph = FlowGraph(json_filename).graph
+
+        sqlite_graph = cls(filename)
+        with sqlite_graph.connection:
+            for seq, job_id in enumerate(graph.nodes_iter()):
+                sqlite_graph._insert_job(
+                    job_id=job_id, seq=seq,
+                    job=dict(graph.node[job_id]),
+                    is_leaf=graph.out_degree(job_id) == 0)
+            sqlite_graph.connection.executemany(
+                "INSERT INTO edges (source, target) VALUES (?, ?)",
+                graph.edges_iter())
+        return sqlite_graph
+
+    def serialize(self):
+        self.connection.commit()
+
+    @property
+    def graph(self):
+        """
+        The full graph as a networkx graph.
+
+        This has to load everything and is only meant for callers that
+        require the networkx API. Changes to it are not persisted.
+        """
+        graph = nx.DiGraph()
+        for job_id, in self.connection.execute(
+                "SELECT id FROM jobs ORDER BY seq"):
+            graph.add_node(job_id, attr_dict=dict(self[job_id]))
+        graph.add_edges_from(self.connection.execute(
+            "SELECT source, target FROM edges"))
+        return graph
+
+    def get_json(self):
+        return networkx.readwrite.json_graph.node_link_data(self.graph)
+
+    def _insert_job(self, job_id, seq, job, is_leaf=True):
+        job = dict(job)
+        run_information = job.pop("run_information", None)
+        self.connection.execute(
+            "INSERT INTO jobs (id, seq, job_status, priority, critical, "
+            "is_leaf, attributes) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, seq, job.get("job_status"), job.get("priority", 0),
+             int(job.get("critical", False)), int(is_leaf), json.dumps(job)))
+        if run_information is not None:
+            self.connection.execute(
+                "INSERT INTO run_information (job_id, data) VALUES (?, ?)",
+                (job_id, json.dumps(run_information)))
+
+    def _write_job(self, job_id, job):
+        job = dict(job)
+        run_information = job.pop("run_information", None)
+        self.connection.execute(
+            "UPDATE jobs SET job_status = ?, priority = ?, critical = ?, "
+            "attributes = ? WHERE id = ?",
+            (job.get("job_status"), job.get("priority", 0),
+             int(job.get("critical", False)), json.dumps(job), job_id))
+        if run_information is None:
+            self.connection.execute(
+                "DELETE FROM run_information WHERE job_id = ?", (job_id,))
+        else:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO run_information (job_id, data) "
+                "VALUES (?, ?)", (job_id, json.dumps(run_information)))
+
+    def _job_changed(self, job_id, key):
+        """
+        Called by the jobs after any of their attributes changed.
+        """
+        self._write_job(job_id, self._jobs[job_id])
+
+    def add_job(self, task_type, inputs, priority=0, from_node=None,
+                critical=False):
+        now = datetime.datetime.now()
+        graph_id = now.strftime("%y%m%dT%H%M%S_") + task_type + "_" + str(
+            uuid.uuid4())
+        seq, = self.connection.execute(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM jobs").fetchone()
+        self._insert_job(job_id=graph_id, seq=seq, job={
+            "task_type": task_type,
+            "inputs": inputs,
+            "priority": priority,
+            "critical": critical,
+            "job_status": "not started"
+        })
+
+        if from_node:
+            print("Adding edge from", from_node, "to", graph_id)
+            self.connection.execute(
+                "INSERT INTO edges (source, target) VALUES (?, ?)",
+                (from_node, graph_id))
+            # The parent is no longer a leaf.
+            self.connection.execute(
+                "UPDATE jobs SET is_leaf = 0 WHERE id = ?", (from_node,))
+
+        return graph_id, self[graph_id]
+
+    def get_current_or_next_job(self):
+        """
+        Get the current or next job.
+        """
+        # Only jobs that have no outwards pointing edges are candidates.
+        if self.connection.execute(
+                "SELECT 1 FROM jobs WHERE is_leaf = 1 LIMIT 1").fetchone() \
+                is None:
+            raise NoJobsLeft
+
+        # A running job is always the current one.
+        running_nodes = self.connection.execute(
+            "SELECT id FROM jobs WHERE is_leaf = 1 AND job_status = 'running'"
+            " LIMIT 2").fetchall()
+        assert len(running_nodes) <= 1, "Only one job can be active at any " \
+                                        "given time."
+        if running_nodes:
+            return running_nodes[0][0]
+
+        # Otherwise the runnable job on the critical path with the highest
+        # priority.
+        next_node = self.connection.execute(
+            "SELECT id FROM jobs WHERE is_leaf = 1 AND "
+            "COALESCE(job_status, '') NOT IN ('running', 'success') "
+            "ORDER BY critical DESC, priority DESC, seq LIMIT 1").fetchone()
+        if next_node is None:
+            raise NoJobsLeft
+
+        return next_node[0]
+
+    def get_running_jobs(self):
+        """
+        Ids of all running jobs in insertion order.
+        """
+        return [_i[0] for _i in self.connection.execute(
+            "SELECT id FROM jobs WHERE is_leaf = 1 AND job_status = 'running'"
+            " ORDER BY seq")]
+
+    def get_runnable_jobs(self):
+        """
+        Ids of all leaf jobs that are neither running nor successful in the
+        order they would be scheduled.
+        """
+        return [_i[0] for _i in self.connection.execute(
+            "SELECT id FROM jobs WHERE is_leaf = 1 AND "
+            "COALESCE(job_status, '') NOT IN ('running', 'success') "
+            "ORDER BY critical DESC, priority DESC, seq")]
+
+    def __getitem__(self, item):
+        if item in self._jobs:
+            return self._jobs[item]
+
+        row = self.connection.execute(
+            "SELECT j.attributes, r.data FROM jobs j LEFT JOIN "
+            "run_information r ON r.job_id = j.id WHERE j.id = ?",
+            (item,)).fetchone()
+        if row is None:
+            raise KeyError(item)
+
+        job = _Job(self, item, json.loads(row[0]))
+        if row[1] is not None:
+            dict.__setitem__(job, "run_information", json.loads(row[1]))
+        self._jobs[item] = job
+        return job
+
+    def __setitem__(self, item, value):
+        if self.connection.execute("SELECT 1 FROM jobs WHERE id = ?",
+                                   (item,)).fetchone() is None:
+            seq, = self.connection.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM jobs").fetchone()
+            self._insert_job(job_id=item, seq=seq, job=value)
+            self._jobs[item] = _Job(self, item, value)
+        else:
+            self._jobs[item] = _Job(self, item, value)
+            self._write_job(item, value)
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM jobs").fetchone()[0]
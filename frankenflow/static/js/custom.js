@@ -18,6 +18,12 @@ function update_status_on_page(data) {
         $("#status_status").text(current_status);
         $("#status_message").text(current_message);
     }
+
+    // Estimated time saved per iteration by deferring side activities.
+    var savings = _.map(_.keys(data.critical_path_savings).sort(), function(n) {
+        return n + ": " + (data.critical_path_savings[n] / 60.0).toFixed(1) + " min";
+    });
+    $("#status_savings").text(savings.length ? savings.join(", ") : "-");
 };
 
 
@@ -221,6 +227,18 @@ $('#reset_job_button').on('click', function() {
 });
 
 
+$('#resume_job_button').on('click', function() {
+    var selected_node = $("#job_selector").find(":selected").text();
+    $.ajax({
+        url: '/resume/' + selected_node,
+        success: function() {
+            update_graph();
+        }
+    });
+    $('#reset-job-modal').modal('hide');
+});
+
+
 $('#iterate_button').on('click', function() {
     $.ajax({
         url: '/iterate',
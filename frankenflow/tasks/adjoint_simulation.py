@@ -1,6 +1,5 @@
 import os
 import re
-import time
 
 from . import task
 from .. import push_notifications
@@ -10,6 +9,8 @@ class AdjointSimulation(task.Task):
     """
     Run an adjoint simulation.
     """
+    task_resources = {"ssh": 1}
+
     @property
     def required_inputs(self):
         return {"remote_adjoint_source_directory", "iteration_name",
@@ -52,6 +53,18 @@ class AdjointSimulation(task.Task):
         pass
 
     def run(self):
+        # The run might have already been submitted before the task got
+        # interrupted - just reattach to it in that case.
+        if not getattr(self, "hpc_agere_bwd_run_submitted", None):
+            self.submit_run()
+
+        # Suspend the job until the run finished. The status of all jobs is
+        # monitored together.
+        return self.wait_for_hpc_job(
+            job_id=self.hpc_agere_bwd_job_id,
+            walltime_per_event=self.c["walltime_per_event_adjoint"])
+
+    def submit_run(self):
         cmd = ("{agere} run_adjoint --fw_run={fw_run} "
                "--wall-time-per-event={walltime_per_event} "
                "--parallel-events={parallel_events} {adjoint_srcs}").format(
@@ -83,51 +96,23 @@ class AdjointSimulation(task.Task):
             raise ValueError("Could not find 'Launching SES3D' on stdout: %s"
                              % stdout)
 
+        # Never submit the same run twice.
+        self.hpc_agere_bwd_run_submitted = True
+        self.save_checkpoint()
+
         # Send a push notification.
         push_notifications.send_notification(
             title="Launched Adjoint Simulation!",
             message="Adjoint simulation for iteration %s" %
                 self.inputs["iteration_name"])
 
-        # Check if job is done all two minutes.
-        while True:
-            time.sleep(120)
-
-            stdout, stderr = self._run_ssh_command(
-                "%s status" % self.c["hpc_agere_cmd"])
-
-            finished = False
-
-            for line in stdout:
-                line = line.strip()
-                if line.startswith("JOB NUMBER") or line.startswith("====="):
-                    continue
-                line = line.split()
-                if line[0] != self.hpc_agere_bwd_job_id:
-                    continue
-
-                status = line[1].upper()
-
-                self.add_log_entry("Current status of remote job: %s" % status)
-
-                if status == "FINISHED":
-                    finished = True
-                break
-            else:
-                raise ValueError("`agere_status` did not contain run '%s'" %
-                                 self.hpc_agere_bwd_job_id)
-
-            if not finished:
-                continue
-            else:
-                # Send a push notification.
-                push_notifications.send_notification(
-                    title="Finished Adjoint Simulation!",
-                    message="Done with adjoint simulation for iteration %s" %
-                            self.inputs["iteration_name"])
-                break
-
     def check_post_run(self):
+        # Send a push notification.
+        push_notifications.send_notification(
+            title="Finished Adjoint Simulation!",
+            message="Done with adjoint simulation for iteration %s" %
+                    self.inputs["iteration_name"])
+
         # Make sure some kernels have been created.
         kernel_folder = self.remote_listdir(self.hpc_kernel_directory)
         assert len(kernel_folder), "Run should have resulted in some kernels."
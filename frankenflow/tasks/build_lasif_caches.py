@@ -19,12 +19,7 @@ class BuildLASIFCaches(task.Task):
         pass
 
     def run(self):
-        cmd = [self.c["lasif_cmd"], "build_all_caches", "--quick"]
-        returncode = self._run_external_script(
-            cwd=self.c["lasif_project"], cmd=cmd)
-
-        # Should be a good enough check.
-        assert returncode == 0, "Script return with code %i" % returncode
+        self.build_lasif_caches()
 
     def check_post_run(self):
         pass
@@ -35,15 +35,33 @@ class CalculateAdjointSources(task.Task):
         pass
 
     def run(self):
+        # Events finished before the task got interrupted.
+        if not hasattr(self, "finished_events"):
+            self.finished_events = []
+
+        cmds = {}
         for event in self.events:
-            cmd = [self.c["lasif_cmd"], "finalize_adjoint_sources",
-                   "--read_only_caches",
-                   self.inputs["iteration_name"], event]
-            returncode = self._run_external_script(
-                cwd=self.c["lasif_project"], cmd=cmd)
-
-            # Should be a good enough check.
-            assert returncode == 0, "Script return with code %i" % returncode
+            if event in self.finished_events:
+                continue
+            cmds[event] = ["finalize_adjoint_sources", "--read_only_caches",
+                           self.inputs["iteration_name"], event]
+
+        def _event_finished(event, returncode):
+            if returncode != 0:
+                return
+            self.finished_events.append(event)
+            self.save_checkpoint()
+
+        # Each event is independent and the caches are only read.
+        returncodes = self._run_external_scripts(
+            cwd=self.c["lasif_project"], cmds=cmds,
+            parallel=self.c.get("parallel_local_processes", 4),
+            retries=self.c.get("local_process_retries", 2),
+            callback=_event_finished, tool="lasif")
+
+        failed = sorted(_i for _i, code in returncodes.items() if code != 0)
+        assert not failed, "Calculating adjoint sources failed for: %s" % (
+            ", ".join(failed))
 
     def check_post_run(self):
         ad_srcs = self.get_adjoint_source_folders()
@@ -23,14 +23,9 @@ class CalculateMisfit(task.Task):
 
     def run(self):
         # For a reason I don't understand sometimes not all caches are
-        # built. This is quick (at most a minute) as the cache generation
-        # script has been run before.
-        cmd = [self.c["lasif_cmd"], "build_all_caches", "--quick"]
-        returncode = self._run_external_script(
-            cwd=self.c["lasif_project"], cmd=cmd)
-
-        # Should be a good enough check.
-        assert returncode == 0, "Script return with code %i" % returncode
+        # built. Only rebuilds them if the data changed in the meanwhile and
+        # logs what changed.
+        self.build_lasif_caches()
 
         cmd = ["mpirun", "-n", "4", self.c["lasif_cmd"],
                "compare_misfits", "--read_only_caches",
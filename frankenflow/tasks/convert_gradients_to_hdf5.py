@@ -26,32 +26,19 @@ class ConvertGradientsToHDF5(task.Task):
     def stage_data(self):
         # The gradient needs a boxfile. Just get it from the corresponding
         # model which should always have one.
-        self.boxfile = os.path.join(
-            self.inputs["local_binary_gradient_directory"], "boxfile")
-        if os.path.exists(self.boxfile):
-            return
-        cmd = [
-            "h5dump",
-            "-d",
-            "_meta/boxfile",
-            "-b",
-            "-o",
-            self.boxfile,
-            self.hdf5_model_path]
-        self._run_external_script(cwd=".", cmd=cmd)
+        self.boxfile = self.copy_boxfile(
+            self.inputs["local_binary_gradient_directory"])
 
     def check_post_staging(self):
         assert os.path.exists(self.boxfile), \
             "boxfile could not be extracted from the model for some reason."
 
     def run(self):
-        cmd = [
-            self.context["config"]["agere_cmd"],
+        self.run_agere([
             "binary_model_to_hdf5",
             self.c["lasif_project"],
             self.inputs["local_binary_gradient_directory"],
-            self.hdf5_gradient_filename]
-        self._run_external_script(cwd=".", cmd=cmd)
+            self.hdf5_gradient_filename])
 
     def check_post_run(self):
         # Now it should exist.
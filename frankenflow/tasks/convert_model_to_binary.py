@@ -26,12 +26,10 @@ class ConvertModelToBinary(task.Task):
         pass
 
     def run(self):
-        cmd = [
-            self.context["config"]["agere_cmd"],
+        self.run_agere([
             "hdf5_model_to_binary",
             self.hdf5_model_path,
-            self.binary_model_path]
-        self._run_external_script(cwd=".", cmd=cmd)
+            self.binary_model_path])
 
     def check_post_run(self):
         # Now it should exist.
@@ -1,5 +1,6 @@
 import glob
 import os
+import shlex
 
 from . import task
 
@@ -8,6 +9,8 @@ class CopyAdjointSourcesToHPC(task.Task):
     """
     Copy adjoint sources to the HPC.
     """
+    task_resources = {"ssh": 1}
+
     @property
     def required_inputs(self):
         return {"iteration_name"}
@@ -64,36 +67,53 @@ class CopyAdjointSourcesToHPC(task.Task):
         self.remote_listdir(self.remote_adjoint_source_directory)
 
     def run(self):
-        for folder in self.folders_to_copy:
-            target = os.path.join(
-                self.remote_adjoint_source_directory,
-                os.path.basename(folder))
-
-            cmd = ["rsync", "-aP", "--timeout=30",
-                   folder + "/", "%s:%s" % (
-                self.c["hpc_remote_host"], target)]
-
-            # We really don't want this to fail!
-            retcode = self._run_external_script(cwd=".", cmd=cmd, retry=20)
-
-            if retcode != 0:
-                raise Exception("rsync failed for %s." %
-                                os.path.basename(folder))
+        # Send all folders with only a few rsync processes to not pay for the
+        # connection setup and file list negotiation for every event.
+        streams = max(1, min(self.c.get("rsync_streams", 1),
+                             len(self.folders_to_copy)))
+        cmds = {}
+        for _i in range(streams):
+            folders = sorted(self.folders_to_copy)[_i::streams]
+            cmds["rsync_%i" % _i] = \
+                ["rsync", "-aP", "--timeout=30"] + folders + [
+                    "%s:%s/" % (self.c["hpc_remote_host"],
+                                self.remote_adjoint_source_directory)]
+
+        # We really don't want this to fail! rsync only transfers what is
+        # still missing when retried.
+        returncodes = self._run_external_scripts(
+            cwd=".", cmds=cmds, parallel=streams, retries=20, retry_delay=20)
+
+        failed = sorted(_i for _i, code in returncodes.items() if code != 0)
+        if failed:
+            raise Exception("rsync failed for %s." % ", ".join(failed))
 
     def check_post_run(self):
-        # Make sure everything has been copied.
-        for folder in self.folders_to_copy:
-            local_contents = set(os.listdir(folder))
-            remote_folder = os.path.join(
-                self.remote_adjoint_source_directory,
-                os.path.basename(folder))
-            remote_contents = set(self.remote_listdir(remote_folder))
+        # Make sure everything has been copied - with a single listing of
+        # all remote files and their sizes.
+        stdout, stderr = self._run_ssh_command(
+            "cd %s && find . -type f -printf '%%s %%P\\n'" % shlex.quote(
+                self.remote_adjoint_source_directory))
+        assert not stderr, "Could not list remote files: %s" % stderr
+        remote_files = {}
+        for line in stdout:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            size, path = line.split(" ", 1)
+            remote_files[path] = int(size)
 
-            difference = local_contents.difference(remote_contents)
-
-            assert not difference, (
-                "Remote folder '%s' has different contents than local folder "
-                "'%s'." % (remote_folder, folder))
+        for folder in self.folders_to_copy:
+            parent = os.path.dirname(folder)
+            for root, _, files in os.walk(folder):
+                for filename in files:
+                    filename = os.path.join(root, filename)
+                    path = os.path.relpath(filename, parent)
+                    assert remote_files.get(path) == \
+                        os.path.getsize(filename), (
+                            "File '%s' has not been copied completely to "
+                            "'%s'." % (filename,
+                                       self.remote_adjoint_source_directory))
 
     def generate_next_steps(self):
         next_steps = [
@@ -2,12 +2,15 @@ import os
 import time
 
 from . import task
+from .. import sftp_transfer
 
 
 class CopyGradientsFromHPC(task.Task):
     """
-    Tar the waveforms on the HPC. This can easily take on hour.
+    Copy the summed kernels from the HPC.
     """
+    task_resources = {"ssh": 1}
+
     @property
     def required_inputs(self):
         return {"summed_kernel_directory"}
@@ -35,6 +38,10 @@ class CopyGradientsFromHPC(task.Task):
         pass
 
     def run(self):
+        if self.get_transfer_codec() == "shuffle":
+            self._copy_encoded()
+            return
+
         cmd = ["rsync", "-aP",
                "%s:%s/" % (self.c["hpc_remote_host"],
                            self.inputs["summed_kernel_directory"]),
@@ -43,6 +50,35 @@ class CopyGradientsFromHPC(task.Task):
         retcode = self._run_external_script(cwd=".", cmd=cmd)
         assert retcode == 0, "rsync encountered an error."
 
+    def _copy_encoded(self):
+        """
+        Copy all kernel files compressed with the shuffle codec.
+        """
+        # Might exist from an interrupted attempt - all files are copied
+        # again.
+        os.makedirs(self.local_kernel_directory, exist_ok=True)
+
+        start = time.time()
+        size = 0
+        transferred = 0
+        for filename in sorted(self.kernel_files):
+            _size, _transferred = self.remote_get_encoded(
+                remotepath=os.path.join(
+                    self.inputs["summed_kernel_directory"], filename),
+                localpath=os.path.join(self.local_kernel_directory,
+                                       filename))
+            size += _size
+            transferred += _transferred
+        runtime = time.time() - start
+
+        self.add_log_entry(
+            "Copied %s of kernels in %.1f seconds (%s/s). Transferred %s - "
+            "a compression ratio of %.2f." % (
+                sftp_transfer.format_size(size), runtime,
+                sftp_transfer.format_size(size / max(runtime, 1E-6)),
+                sftp_transfer.format_size(transferred),
+                size / max(transferred, 1)))
+
     def check_post_run(self):
         # Make sure the kernels have been copied.
         kernel_folder = os.listdir(self.local_kernel_directory)
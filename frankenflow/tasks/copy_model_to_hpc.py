@@ -10,6 +10,8 @@ class CopyModelToHPC(task.Task):
 
     The model must reside in the associated LASIF project.
     """
+    task_resources = {"ssh": 1}
+
     @property
     def required_inputs(self):
         return {"iteration_name"}
@@ -55,24 +57,38 @@ class CopyModelToHPC(task.Task):
                 self.remote_target_directory))
 
     def run(self):
+        files = []
         for filename in os.listdir(self.binary_model_path):
             src = os.path.join(self.binary_model_path, filename)
             target = os.path.join(self.remote_target_directory, filename)
-            self.remote_put(src, target)
+            files.append((src, target))
+
+        # A single SFTP channel does not saturate the link.
+        self.remote_put_many(
+            files, parallel=self.c.get("sftp_parallel_channels", 4),
+            codec=self.get_transfer_codec())
 
     def check_post_run(self):
         # Make sure all files have been copied.
-        remote_files = set(
-            self.remote_listdir(self.remote_target_directory))
+        remote_files = self.remote_listdir_attr(self.remote_target_directory)
 
         local_files = set(os.listdir(self.binary_model_path))
 
-        missing_files = local_files.difference(remote_files)
+        missing_files = local_files.difference(set(remote_files.keys()))
 
         assert not missing_files, \
             "The following files could not be copied: %s" % (
                 ", ".join(missing_files))
 
+        # The same listing also tells us if they are complete.
+        incomplete_files = [
+            _i for _i in local_files if remote_files[_i].size !=
+            os.path.getsize(os.path.join(self.binary_model_path, _i))]
+
+        assert not incomplete_files, \
+            "The following files have not been copied completely: %s" % (
+                ", ".join(incomplete_files))
+
     def generate_next_steps(self):
         next_steps = [
             # Run the forward adjoint.
@@ -1,13 +1,26 @@
+import hashlib
 import os
-import time
+import shlex
+import socket
+
+import paramiko
 
 from . import task
+from .. import sftp_transfer
 
 
 class CopyWaveformsFromHPC(task.Task):
     """
-    Tar the waveforms on the HPC. This can easily take on hour.
+    Copy the tarred waveforms from the HPC.
+
+    Interrupted transfers are continued where they stopped and the copy is
+    verified with a checksum computed on the HPC.
     """
+    task_resources = {"ssh": 1}
+
+    # Number of times a transfer is continued after the connection died.
+    transfer_retries = 10
+
     @property
     def required_inputs(self):
         return {"remote_waveform_tar_file"}
@@ -20,15 +33,16 @@ class CopyWaveformsFromHPC(task.Task):
             os.path.basename(self.inputs["remote_waveform_tar_file"]))
 
         # Make sure the tar file exists.
-        files = self.remote_listdir(
-            os.path.dirname(self.inputs["remote_waveform_tar_file"]))
-        assert os.path.basename(self.inputs["remote_waveform_tar_file"]) in \
-               files, "Remote file '%s' does not exists." % (
-            self.inputs["remote_waveform_tar_file"])
+        assert self.remote_path_exists(
+            self.inputs["remote_waveform_tar_file"]), \
+            "Remote file '%s' does not exists." % (
+                self.inputs["remote_waveform_tar_file"])
 
-        # And that the target file does not yet exist.
-        assert not os.path.exists(self.target_file), \
-            "File '%s' does already exist."
+        # An existing target file is the result of an interrupted attempt
+        # and will be continued.
+        if os.path.exists(self.target_file):
+            self.add_log_entry("Continuing partial download '%s'." %
+                               self.target_file)
 
     def stage_data(self):
         pass
@@ -36,14 +50,60 @@ class CopyWaveformsFromHPC(task.Task):
     def check_post_staging(self):
         pass
 
+    def _get_remote_checksum(self, channel_stdout=None):
+        """
+        SHA-256 of the remote file. Pass the stdout of an already running
+        `sha256sum` to just collect its result.
+        """
+        if channel_stdout is not None:
+            try:
+                return channel_stdout.read().decode().split()[0]
+            # The connection died in the meanwhile.
+            except (IndexError, EOFError, OSError, paramiko.SSHException):
+                pass
+        stdout, _ = self._run_ssh_command(
+            "sha256sum %s" % shlex.quote(
+                self.inputs["remote_waveform_tar_file"]))
+        return "".join(stdout).split()[0]
+
     def run(self):
-        cmd = ["scp",
-               "%s:%s" % (self.c["hpc_remote_host"],
-                          self.inputs["remote_waveform_tar_file"]),
-               self.target_file]
+        remote_file = self.inputs["remote_waveform_tar_file"]
+
+        # Compute the checksum on the HPC during the transfer.
+        _, remote_checksum, _ = self.ssh_client.exec_command(
+            "sha256sum %s" % shlex.quote(remote_file))
+
+        checksum = hashlib.sha256()
+        # Data of a previous attempt has to be hashed once.
+        if os.path.exists(self.target_file):
+            with open(self.target_file, "rb") as fh:
+                for chunk in iter(lambda: fh.read(16 * 1024 * 1024), b""):
+                    checksum.update(chunk)
+
+        for _ in range(self.transfer_retries):
+            try:
+                sftp_transfer.download_file(
+                    sftp_client=self.sftp_client, remotepath=remote_file,
+                    localpath=self.target_file, checksum=checksum,
+                    log=self.add_log_entry)
+                break
+            except (socket.timeout, EOFError, OSError,
+                    paramiko.SSHException) as e:
+                self.add_log_entry("Transfer interrupted: %s. Reconnecting "
+                                   "to continue ..." % str(e))
+                self._init_ssh_and_stfp_clients()
+        else:
+            raise ValueError("Could not copy '%s' after %i attempts." % (
+                remote_file, self.transfer_retries))
+
+        remote_checksum = self._get_remote_checksum(remote_checksum)
+        self.add_log_entry("SHA-256 local: %s, remote: %s" % (
+            checksum.hexdigest(), remote_checksum))
 
-        retcode = self._run_external_script(cwd=".", cmd=cmd)
-        assert retcode == 0, "scp encountered an error."
+        if checksum.hexdigest() != remote_checksum:
+            # Start from scratch next time.
+            os.remove(self.target_file)
+            raise ValueError("Checksum mismatch for '%s'." % remote_file)
 
     def check_post_run(self):
         # Make sure it exists now.
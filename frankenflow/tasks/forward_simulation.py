@@ -1,5 +1,4 @@
 import os
-import time
 
 from . import task
 from .. import push_notifications
@@ -12,6 +11,8 @@ class ForwardSimulation(task.Task):
 
     The model must reside in the associated LASIF project.
     """
+    task_resources = {"ssh": 1}
+
     @property
     def required_inputs(self):
         return {"iteration_name"}
@@ -37,6 +38,13 @@ class ForwardSimulation(task.Task):
                 self.remote_input_file_directory,
                 self.context["config"]["number_of_events"]))
 
+        # Harvesting waveforms during the run requires a way to tell
+        # finished events apart.
+        if self.c.get("waveform_transfer", "stream") == "pipeline":
+            assert "waveform_completion_marker" in self.c, \
+                "'waveform_completion_marker' must be given in the config " \
+                "file for the 'pipeline' waveform transfer."
+
         # Model directory.
         self.remote_model_directory = os.path.join(
             self.context["config"]["hpc_agere_project"],
@@ -54,6 +62,104 @@ class ForwardSimulation(task.Task):
         pass
 
     def run(self):
+        # The run might have already been submitted before the task got
+        # interrupted - just reattach to it in that case.
+        if not getattr(self, "hpc_agere_fwd_job_id", None):
+            self.submit_run()
+
+        # Suspend the job until the run finished. The status of all jobs is
+        # monitored together.
+        wait_condition = self.wait_for_hpc_job(
+            job_id=self.hpc_agere_fwd_job_id,
+            walltime_per_event=self.c["walltime_per_event_forward"])
+
+        # Also wake up for events that finished in the meanwhile to harvest
+        # their waveforms.
+        if self.c.get("waveform_transfer", "stream") == "pipeline":
+            if not hasattr(self, "harvested_events"):
+                self.harvested_events = []
+            wait_condition.check = "check_forward_run"
+            wait_condition.then = "harvest_waveforms"
+
+        return wait_condition
+
+    def check_forward_run(self, job_id, expected_end_time, not_before):
+        """
+        Check if the run finished or if any events finished that have not
+        yet been harvested.
+        """
+        ret_val = self.check_hpc_job(job_id=job_id,
+                                     expected_end_time=expected_end_time,
+                                     not_before=not_before)
+        self.events_to_harvest = []
+        if ret_val is True:
+            return True
+
+        ret_val.check = "check_forward_run"
+        ret_val.then = "harvest_waveforms"
+
+        # Harvesting is just an optimization - events that could not be
+        # harvested are transferred once the run finished.
+        try:
+            self.events_to_harvest = self.get_finished_events()
+        except Exception as e:
+            self.add_log_entry("Checking for finished events failed: %s: %s"
+                               % (e.__class__.__name__, str(e)))
+        if not self.events_to_harvest:
+            return ret_val
+
+        # Continue waiting like this after the harvest.
+        self.next_wait_condition = ret_val.to_dict()
+        return True
+
+    def get_finished_events(self):
+        """
+        Events of the run that have not been harvested yet and whose
+        waveform folders contain the ``waveform_completion_marker`` file.
+        """
+        waveform_directory = os.path.join(
+            self.c["hpc_agere_project"], "__WAVEFORMS",
+            self.hpc_agere_fwd_job_id)
+        if not self.remote_path_exists(waveform_directory):
+            return []
+
+        events = [_i for _i in self.remote_listdir(waveform_directory)
+                  if _i not in self.harvested_events]
+        markers = {
+            _i: os.path.join(waveform_directory, _i,
+                             self.c["waveform_completion_marker"])
+            for _i in events}
+        stats = self.remote_stat_many(list(markers.values()))
+        return sorted(_i for _i in events if stats[markers[_i]] is not None)
+
+    def harvest_waveforms(self):
+        """
+        Transfer and unpack the waveforms of the events found by
+        check_forward_run() and continue to wait for the run.
+        """
+        if not self.events_to_harvest:
+            # The run finished. All remaining events are transferred by the
+            # next job.
+            return None
+
+        events = self.events_to_harvest
+        self.add_log_entry("Harvesting waveforms of %i finished event(s): "
+                           "%s" % (len(events), ", ".join(events)))
+        try:
+            self.stream_and_unpack_waveforms(
+                hpc_agere_fwd_job_id=self.hpc_agere_fwd_job_id,
+                filename=os.path.join(self.working_dir, "harvest.tar"),
+                events=events)
+        except Exception as e:
+            self.add_log_entry("Harvesting waveforms failed: %s: %s" % (
+                e.__class__.__name__, str(e)))
+        else:
+            self.harvested_events.extend(events)
+            self.save_checkpoint()
+
+        return task.WaitCondition(**self.next_wait_condition)
+
+    def submit_run(self):
         c = self.context["config"]
 
         # Make sure the model directory exists.
@@ -91,51 +197,22 @@ class ForwardSimulation(task.Task):
             raise ValueError("Could not find run number on stdout: %s" %
                              stdout)
 
+        # Never submit the same run twice.
+        self.save_checkpoint()
+
         # Send a push notification.
         push_notifications.send_notification(
             title="Launched Forward Simulation!",
             message="Forward simulation for iteration %s" %
                 self.inputs["iteration_name"])
 
-        # Check if job is done all two minutes.
-        while True:
-            time.sleep(10)
-
-            stdout, stderr = self._run_ssh_command(
-                "%s status" % self.c["hpc_agere_cmd"])
-
-            finished = False
-
-            for line in stdout:
-                line = line.strip()
-                if line.startswith("JOB NUMBER") or line.startswith("====="):
-                    continue
-                line = line.split()
-                if line[0] != self.hpc_agere_fwd_job_id:
-                    continue
-
-                status = line[1].upper()
-
-                self.add_log_entry("Current status of remote job: %s" % status)
-
-                if status == "FINISHED":
-                    finished = True
-                break
-            else:
-                raise ValueError("`agere_status` did not contain run '%s'" %
-                                 self.hpc_agere_fwd_job_id)
-
-            if not finished:
-                continue
-            else:
-                # Send a push notification.
-                push_notifications.send_notification(
-                    title="Finished Forward Simulation!",
-                    message="Done with forward simulation for iteration %s" %
-                            self.inputs["iteration_name"])
-                break
-
     def check_post_run(self):
+        # Send a push notification.
+        push_notifications.send_notification(
+            title="Finished Forward Simulation!",
+            message="Done with forward simulation for iteration %s" %
+                    self.inputs["iteration_name"])
+
         c = self.context["config"]
 
         # Check if some waveform folders have been generated. This is necessary
@@ -148,12 +225,19 @@ class ForwardSimulation(task.Task):
         assert len(event_folders), "Run should have resulted in some events."
 
     def generate_next_steps(self):
+        # Either stream the waveforms directly or tar them on the HPC, copy,
+        # and unpack them in separate steps.
+        inputs = {"hpc_agere_fwd_job_id": self.hpc_agere_fwd_job_id}
+        if self.c.get("waveform_transfer", "stream") == "tar":
+            task_type = "TarWaveformsOnHPC"
+        else:
+            task_type = "StreamWaveformsFromHPC"
+            if hasattr(self, "harvested_events"):
+                inputs["harvested_events"] = self.harvested_events
+
         next_steps = [
-            # Tar the waveforms.
-            {"task_type": "TarWaveformsOnHPC",
-             "inputs": {
-                 "hpc_agere_fwd_job_id": self.hpc_agere_fwd_job_id
-             },
+            {"task_type": task_type,
+             "inputs": inputs,
              "priority": 0
              }
         ]
@@ -22,27 +22,17 @@ class MigrateWindows(task.Task):
 
     def run(self):
         # First create a new iteration starting from iteration 0.
-        cmd = [self.c["lasif_cmd"],
-               "create_successive_iteration",
-               "000",
-               self.inputs["iteration_name"]]
-
-        returncode = self._run_external_script(
-            cwd=self.c["lasif_project"], cmd=cmd)
+        returncode = self.run_lasif(["create_successive_iteration", "000",
+                                     self.inputs["iteration_name"]])
         assert returncode == 0, (
             "'create_successive_iteration' script return with code %i" %
             returncode)
 
         # Migrate the windows.
-        cmd = [self.c["lasif_cmd"],
-               "migrate_windows",
-               "000",
-               self.inputs["iteration_name"]]
-
-        returncode = self._run_external_script(
-            cwd=self.c["lasif_project"], cmd=cmd)
+        returncode = self.run_lasif(["migrate_windows", "000",
+                                     self.inputs["iteration_name"]])
         assert returncode == 0, (
-            "'create_successive_iteration' script return with code %i" %
+            "'migrate_windows' script return with code %i" %
             returncode)
 
     def check_post_run(self):
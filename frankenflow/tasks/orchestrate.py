@@ -14,6 +14,7 @@ class Orchestrate(task.Task):
     # No goal required for orchestration. The whole point of the orchestrate
     # node is to assign a new goal.
     task_requires_active_goal = False
+    task_may_set_new_goal = True
 
     @property
     def required_inputs(self):
@@ -11,6 +11,8 @@ class PlotHDF5Gradient(task.Task):
     """
     # No goal required for plotting. It is just a side activity.
     task_requires_active_goal = False
+    task_resources = {"plotting": 1}
+    task_on_critical_path = False
 
     @property
     def required_inputs(self):
@@ -44,14 +46,19 @@ class PlotHDF5Gradient(task.Task):
         pass
 
     def run(self):
+        cmds = {}
+        inputs = {}
+        outputs = {}
         for key, value in self.outputs.items():
-            cmd = [
-                self.context["config"]["agere_cmd"],
+            outputs[key] = os.path.join(self.working_dir, value)
+            inputs[key] = [self.hdf5_gradient_filename]
+            cmds[key] = [
                 "plot_hdf5",
                 self.hdf5_gradient_filename,
                 key,
-                os.path.join(self.working_dir, value)]
-            self._run_external_script(cwd=".", cmd=cmd)
+                outputs[key]]
+        self._run_plotting_scripts(cwd=".", cmds=cmds, inputs=inputs,
+                                   outputs=outputs, tool="agere")
 
     def check_post_run(self):
         # Copy the files
@@ -11,6 +11,8 @@ class PlotRegularGridGradient(task.Task):
     """
     # No goal required for plotting. It is just a side activity.
     task_requires_active_goal = False
+    task_resources = {"plotting": 1}
+    task_on_critical_path = False
 
     @property
     def required_inputs(self):
@@ -50,16 +52,23 @@ class PlotRegularGridGradient(task.Task):
         pass
 
     def run(self):
+        cmds = {}
+        inputs = {}
+        outputs = {}
         for key, value in self.outputs.items():
-            cmd = [
-                self.context["config"]["agere_cmd"],
+            outputs[key] = os.path.join(self.working_dir, value)
+            inputs[key] = [os.path.join(self.gradient_directory, key),
+                           self.lasif_config_file]
+            inputs[key].extend(self.context["data"]["block_files"])
+            cmds[key] = [
                 "plot_kernel",
                 "--lasif_project=%s" % self.context["config"]["lasif_project"],
                 "%s" % os.path.join(self.gradient_directory, key),
                 "100",
-                "--filename=%s" % os.path.join(self.working_dir, value),
+                "--filename=%s" % outputs[key],
                 "--blockfile_folder=%s" % self.context["data_folder"]]
-            self._run_external_script(cwd=".", cmd=cmd)
+        self._run_plotting_scripts(cwd=".", cmds=cmds, inputs=inputs,
+                                   outputs=outputs, tool="agere")
 
     def check_post_run(self):
         # Copy the files
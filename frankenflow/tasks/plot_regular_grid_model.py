@@ -11,6 +11,8 @@ class PlotRegularGridModel(task.Task):
     """
     # No goal required for plotting. It is just a side activity.
     task_requires_active_goal = False
+    task_resources = {"plotting": 1}
+    task_on_critical_path = False
 
     @property
     def required_inputs(self):
@@ -10,6 +10,8 @@ class PlotSES3DBinaryFormatModel(task.Task):
     """
     # No goal required for plotting. It is just a side activity.
     task_requires_active_goal = False
+    task_resources = {"plotting": 1}
+    task_on_critical_path = False
 
     @property
     def required_inputs(self):
@@ -28,23 +30,28 @@ class PlotSES3DBinaryFormatModel(task.Task):
 
     def run(self):
         self.filenames = []
+        cmds = {}
+        inputs = {}
+        outputs = {}
         variables = ["rho", "vsv", "vsh", "vp"]
         for variable in variables:
             filename = "model_%s_%s_100km_depth.jpg" % (
                 self.inputs["iteration_name"], variable)
             filename = os.path.join(self.working_dir, filename)
             self.filenames.append(filename)
-            cmd = [
-                self.context["config"]["lasif_cmd"],
+            outputs[variable] = filename
+            inputs[variable] = [self.binary_model_path,
+                                self.lasif_config_file]
+            cmds[variable] = [
                 "plot_model",
                 os.path.basename(self.binary_model_path),
                 "100",
                 variable,
                 filename]
 
-            self._run_external_script(
-                cwd=self.context["config"]["lasif_project"],
-                cmd=cmd)
+        self._run_plotting_scripts(
+            cwd=self.context["config"]["lasif_project"], cmds=cmds,
+            inputs=inputs, outputs=outputs, tool="lasif")
 
     def check_post_run(self):
         # Copy the files
@@ -10,6 +10,8 @@ class PlotSpectralElementGridGradient(task.Task):
     """
     # No goal required for plotting. It is just a side activity.
     task_requires_active_goal = False
+    task_resources = {"plotting": 1}
+    task_on_critical_path = False
 
     @property
     def required_inputs(self):
@@ -25,19 +27,8 @@ class PlotSpectralElementGridGradient(task.Task):
     def stage_data(self):
         # The gradient needs a boxfile. Just get it from the corresponding
         # model which should always have one.
-        self.boxfile = os.path.join(
-            self.inputs["local_binary_gradient_directory"], "boxfile")
-        if os.path.exists(self.boxfile):
-            return
-        cmd = [
-            "h5dump",
-            "-d",
-            "_meta/boxfile",
-            "-b",
-            "-o",
-            self.boxfile,
-            self.hdf5_model_path]
-        self._run_external_script(cwd=".", cmd=cmd)
+        self.boxfile = self.copy_boxfile(
+            self.inputs["local_binary_gradient_directory"])
 
     def check_post_staging(self):
         assert os.path.exists(self.boxfile), \
@@ -45,23 +36,30 @@ class PlotSpectralElementGridGradient(task.Task):
 
     def run(self):
         self.filenames = []
+        cmds = {}
+        inputs = {}
+        outputs = {}
         variables = ["grad_rho", "grad_csv", "grad_csh", "grad_cp"]
         for variable in variables:
             filename = "%s_%s_100km_depth.jpg" % (
                 self.inputs["iteration_name"], variable)
             filename = os.path.join(self.working_dir, filename)
             self.filenames.append(filename)
-            cmd = [
-                self.context["config"]["lasif_cmd"],
+            outputs[variable] = filename
+            # Includes the boxfile copied to it.
+            inputs[variable] = [
+                self.inputs["local_binary_gradient_directory"],
+                self.lasif_config_file]
+            cmds[variable] = [
                 "plot_kernel",
                 self.inputs["local_binary_gradient_directory"],
                 "100",
                 variable,
                 filename]
 
-            self._run_external_script(
-                cwd=self.context["config"]["lasif_project"],
-                cmd=cmd)
+        self._run_plotting_scripts(
+            cwd=self.context["config"]["lasif_project"], cmds=cmds,
+            inputs=inputs, outputs=outputs, tool="lasif")
 
     def check_post_run(self):
         # Copy the files
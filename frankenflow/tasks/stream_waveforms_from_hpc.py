@@ -0,0 +1,70 @@
+import os
+
+from . import task
+
+
+class StreamWaveformsFromHPC(task.Task):
+    """
+    Stream the waveforms of a forward run from the HPC and unpack them to
+    the LASIF project.
+
+    Replaces TarWaveformsOnHPC, CopyWaveformsFromHPC, and UnpackWaveforms.
+    The tar file is created on the fly on the HPC and directly sent over the
+    SSH connection so no intermediate file is written and read again on the
+    HPC. The three separate tasks are still used if `waveform_transfer` is
+    set to `tar` in the config file.
+    """
+    task_resources = {"ssh": 1}
+
+    @property
+    def required_inputs(self):
+        return {"hpc_agere_fwd_job_id", "iteration_name"}
+
+    def check_pre_staging(self):
+        self._init_ssh_and_stfp_clients()
+
+        # Check if all events have been simulated. This is done in this
+        # stage to manually finish the previous one if necessary.
+        self.remote_waveform_directory = self.check_remote_waveforms(
+            self.inputs["hpc_agere_fwd_job_id"])
+
+        self.target_file = os.path.join(
+            self.working_dir, "%s.tar" % self.inputs["hpc_agere_fwd_job_id"])
+
+        # Make sure the target file does not yet exist.
+        assert not os.path.exists(self.target_file), \
+            "File '%s' does already exist." % self.target_file
+
+    def stage_data(self):
+        pass
+
+    def check_post_staging(self):
+        pass
+
+    def run(self):
+        # Events might have already been harvested during the forward run.
+        harvested_events = set(self.inputs.get("harvested_events", []))
+        events = sorted(set(self.remote_listdir(
+            self.remote_waveform_directory)).difference(harvested_events))
+        self.add_log_entry("%i events have already been harvested, %i "
+                           "remaining." % (len(harvested_events),
+                                           len(events)))
+        if not events:
+            return
+
+        self.stream_and_unpack_waveforms(
+            hpc_agere_fwd_job_id=self.inputs["hpc_agere_fwd_job_id"],
+            filename=self.target_file,
+            events=events if harvested_events else None)
+
+    def check_post_run(self):
+        pass
+
+    def generate_next_steps(self):
+        next_steps = [
+            # Build the LASIF caches.
+            {"task_type": "BuildLASIFCaches",
+             "priority": 0
+             }
+        ]
+        return next_steps
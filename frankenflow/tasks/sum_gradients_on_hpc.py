@@ -10,6 +10,8 @@ class SumGradientsOnHPC(task.Task):
     This is a cheap operation and saves a lot of copy time and just easy to
     justify.
     """
+    task_resources = {"ssh": 1}
+
     @property
     def required_inputs(self):
         return {"hpc_agere_bwd_job_id"}
@@ -40,25 +40,24 @@ class TaperAndPreconditionGradient(task.Task):
         pass
 
     def run(self):
-        cmd = [self.context["config"]["agere_cmd"],
-               "taper_and_precondition_gradient",
-               self.hdf5_gradient_filename,
-               self.hdf5_output_gradient_filename,
-               self.depth_scaling_file,
-               "--longitude_offset_in_km=%s" % str(
-               self.c["taper_longitude_offset_in_km"]),
-               "--colatitude_offset_in_km=%s" % str(
-                   self.c["taper_colatitude_offset_in_km"]),
-               "--depth_offset_in_km=%s" % str(
-                   self.c["taper_depth_offset_in_km"]),
-               "--longitude_width_in_km=%s" % str(
-                   self.c["taper_longitude_width_in_km"]),
-               "--colatitude_width_in_km=%s" % str(
-                   self.c["taper_colatitude_width_in_km"]),
-               "--depth_width_in_km=%s" % str(
-                   self.c["taper_depth_width_in_km"])]
+        args = ["taper_and_precondition_gradient",
+                self.hdf5_gradient_filename,
+                self.hdf5_output_gradient_filename,
+                self.depth_scaling_file,
+                "--longitude_offset_in_km=%s" % str(
+                    self.c["taper_longitude_offset_in_km"]),
+                "--colatitude_offset_in_km=%s" % str(
+                    self.c["taper_colatitude_offset_in_km"]),
+                "--depth_offset_in_km=%s" % str(
+                    self.c["taper_depth_offset_in_km"]),
+                "--longitude_width_in_km=%s" % str(
+                    self.c["taper_longitude_width_in_km"]),
+                "--colatitude_width_in_km=%s" % str(
+                    self.c["taper_colatitude_width_in_km"]),
+                "--depth_width_in_km=%s" % str(
+                    self.c["taper_depth_width_in_km"])]
 
-        returncode = self._run_external_script(cwd=".", cmd=cmd)
+        returncode = self.run_agere(args)
         assert returncode == 0, \
             "Gradient preconditioning exited with return code %i." % returncode
 
@@ -8,6 +8,8 @@ class TarWaveformsOnHPC(task.Task):
     """
     Tar the waveforms on the HPC. This can easily take on hour.
     """
+    task_resources = {"ssh": 1}
+
     @property
     def required_inputs(self):
         return {"hpc_agere_fwd_job_id"}
@@ -15,32 +17,11 @@ class TarWaveformsOnHPC(task.Task):
     def check_pre_staging(self):
         self._init_ssh_and_stfp_clients()
 
-        c = self.context["config"]
-
         # Check if all events have been simulated. This is done in this
         # stage to manually finish the previous one if necessary. The
         # current SES3D version I have sometimes chooses not to simulate all
         # events.
-        waveform_directory = os.path.join(
-            c["hpc_agere_project"], "__WAVEFORMS",
-            self.inputs["hpc_agere_fwd_job_id"])
-
-        # Check that waveforms for enough events are present.
-        event_folders = self.remote_listdir(waveform_directory)
-        assert len(event_folders) == c["number_of_events"], \
-            "Run should have resulted in '%s' events." % c["number_of_events"]
-
-        # Also check they all actually have waveforms.
-        stdout, stderr = self._run_ssh_command(
-            'du %s/*' % waveform_directory)
-        assert not stderr, "stderr during waveform checkign: %s" % stderr
-        # Make sure to remove any empty lines.
-        stdout = [_i.strip() for _i in stdout if _i.strip()]
-        assert len(stdout) == c["number_of_events"], "Should not happen!"
-        # Random threshold of a thousand bytes.
-        stdout = [_i for _i in stdout if int(_i.strip().split()[0]) < 1000]
-        assert not stdout, "Events %s don't have enough waveform data!" % (
-            ", ".join(_i.strip().split()[1] for _i in stdout))
+        self.check_remote_waveforms(self.inputs["hpc_agere_fwd_job_id"])
 
         self.expected_output_file = os.path.join(
             self.c["hpc_agere_project"], "__WAVEFORMS",
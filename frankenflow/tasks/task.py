@@ -1,14 +1,21 @@
 import abc
+import concurrent.futures
+import contextlib
 import datetime
 import functools
 import glob
+import hashlib
+import json
 import os
+import shlex
 import shutil
 import socket
 import subprocess
+import sys
 import time
 
-import paramiko
+from .. import connection_pool, hpc_monitor, remote_filesystem, \
+    sftp_transfer, shuffle_codec, utils, warm_worker
 
 
 class TaskCheckFailed(Exception):
@@ -40,6 +47,62 @@ class retry():
         return wrapped_f
 
 
+class WaitCondition():
+    """
+    Returned by the run stage of a task to suspend it without blocking a
+    worker.
+
+    The task is resumed in a new celery task after ``interval`` seconds by
+    calling its method named ``check`` with ``kwargs``. The method returns
+    True once the condition holds and the task then continues with its
+    remaining stages. False keeps on waiting with the same interval and a
+    new WaitCondition replaces the current one.
+
+    Once the condition holds the method named ``then`` is called if given.
+    It is part of the run stage but the job is no longer suspended and
+    occupies its resources again, so it can do more expensive work. It can
+    again return a WaitCondition.
+    """
+    def __init__(self, check, interval, kwargs=None, then=None):
+        self.check = check
+        self.interval = interval
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.then = then
+
+    def to_dict(self):
+        return {"check": self.check, "interval": self.interval,
+                "kwargs": self.kwargs, "then": self.then}
+
+
+def reconnect_on_transport_error(f):
+    """
+    Decorator that will reconnect and try once more if the SSH connection
+    died during the operation.
+    """
+    @functools.wraps(f)
+    def wrapped_f(self, *args, **kwargs):
+        try:
+            return f(self, *args, **kwargs)
+        except Exception:
+            if connection_pool.pool.is_healthy(self.c["hpc_remote_host"]):
+                raise
+            self.add_log_entry("SSH connection died. Reconnecting ...")
+            self._init_ssh_and_stfp_clients()
+            return f(self, *args, **kwargs)
+
+    return wrapped_f
+
+
+def _link_or_copy(src, dest):
+    """
+    Hard link a file and fall back to copying it, e.g. across file systems.
+    """
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
 class Task(metaclass=abc.ABCMeta):
     """
     A single task.
@@ -61,6 +124,26 @@ class Task(metaclass=abc.ABCMeta):
     # require an active goal will not be assigned one.
     task_requires_active_goal = True
 
+    # Only the orchestration can set a new goal. Jobs requiring an active goal
+    # are never run at the same time as a job that might change it.
+    task_may_set_new_goal = False
+
+    # Resources occupied by the task while it runs. Used by the concurrent
+    # scheduler to limit the number of jobs running at any given time per
+    # resource.
+    task_resources = {"local_cpu": 1}
+
+    # Tasks on the critical path lead to the next HPC simulation or seismopt
+    # run. They are always scheduled before side activities like plotting,
+    # no matter the priority.
+    task_on_critical_path = True
+
+    # Attributes that are not part of the state of a task, either because
+    # they are passed to the constructor or because they are connections.
+    _stateless_attributes = {"context", "c", "inputs", "working_dir",
+                             "stdout", "stderr", "logfile", "ssh_client",
+                             "sftp_client", "remote_fs"}
+
     def __init__(self, context, inputs, working_dir, stdout, stderr, logfile):
         self.context = context
         # Shortcut because its required to have all over the place.
@@ -81,6 +164,78 @@ class Task(metaclass=abc.ABCMeta):
         self.stderr = stderr
         self.logfile = logfile
 
+    def __getattr__(self, name):
+        # Connections are established on first use. This is also the case
+        # for tasks resumed in a different worker.
+        if name in ("ssh_client", "sftp_client", "remote_fs") and \
+                "context" in self.__dict__:
+            self._init_ssh_and_stfp_clients()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def get_state(self):
+        """
+        All JSON serializable attributes set by the stages of the task.
+        """
+        state = {}
+        for key, value in self.__dict__.items():
+            if key in self._stateless_attributes:
+                continue
+            try:
+                json.dumps(value)
+            except TypeError:
+                continue
+            state[key] = value
+        return state
+
+    def set_state(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def checkpoint_filename(self):
+        return os.path.join(self.working_dir, "checkpoint.json")
+
+    def load_checkpoint(self):
+        """
+        Returns the last checkpoint of the task or None if there is none.
+        """
+        try:
+            with open(self.checkpoint_filename, "rt") as fh:
+                return json.load(fh)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save_checkpoint(self, **kwargs):
+        """
+        Checkpoint the current state of the task to its working directory.
+
+        Additional keyword arguments are stored alongside and replace the
+        ones of the previous checkpoint. Tasks should call this as soon as
+        they captured something expensive to reproduce, e.g. the id of a
+        remote job, so an interrupted task can pick up from there.
+        """
+        checkpoint = self.load_checkpoint() or {}
+        checkpoint.update(kwargs)
+        checkpoint["state"] = self.get_state()
+
+        temp_filename = self.checkpoint_filename + ".tmp"
+        with open(temp_filename, "wt") as fh:
+            json.dump(checkpoint, fh)
+        os.replace(temp_filename, self.checkpoint_filename)
+
+    def check_wait_condition(self, wait_condition):
+        """
+        Returns None if the condition holds, otherwise the condition to
+        wait for.
+        """
+        ret_val = getattr(self, wait_condition.check)(
+            **wait_condition.kwargs)
+        if ret_val is True:
+            return None
+        elif ret_val is False:
+            return wait_condition
+        return ret_val
+
     @abc.abstractproperty
     def required_inputs(self):
         """
@@ -113,29 +268,156 @@ class Task(metaclass=abc.ABCMeta):
         pass
 
     @retry(5)
+    @reconnect_on_transport_error
     def remote_mkdir(self, path, mode=511):
+        self.remote_fs.invalidate(os.path.dirname(path))
         return self.sftp_client.mkdir(path=path, mode=mode)
 
     @retry(5)
+    @reconnect_on_transport_error
     def remote_listdir(self, path):
-        return self.sftp_client.listdir(path=path)
+        return self.remote_fs.listdir(path)
+
+    @retry(5)
+    @reconnect_on_transport_error
+    def remote_listdir_attr(self, path):
+        """
+        Name -> RemoteStat with size and modification time for all entries
+        of the remote directory.
+        """
+        return self.remote_fs.listdir_attr(path)
+
+    @retry(5)
+    @reconnect_on_transport_error
+    def remote_stat_many(self, paths):
+        """
+        Path -> RemoteStat, or None if it does not exist, for all paths with
+        at most a single round trip.
+        """
+        return self.remote_fs.stat_many(paths)
 
     @retry(5)
+    @reconnect_on_transport_error
     def remote_put(self, localpath, remotepath):
+        self.remote_fs.invalidate(os.path.dirname(remotepath))
         return self.sftp_client.put(localpath=localpath,
                                     remotepath=remotepath)
+
+    def get_transfer_codec(self):
+        """
+        Codec used by the transfers of this task - either "none" or
+        "shuffle". Set per task type in the config file.
+        """
+        codec = self.c.get("transfer_codecs", {}).get(
+            self.__class__.__name__, "none")
+        assert codec in ("none", "shuffle"), "Unknown codec '%s'." % codec
+        return codec
+
+    def _get_remote_codec_command(self):
+        """
+        Command running the shuffle codec on the HPC with
+        ``hpc_python_cmd`` (from the config file, defaults to ``python3``).
+        The codec is copied to the agere project if necessary.
+        """
+        local_path = shuffle_codec.__file__
+        remote_path = os.path.join(self.c["hpc_agere_project"],
+                                   "frankenflow_shuffle_codec.py")
+        remote_stat = self.remote_fs.stat(remote_path)
+        if remote_stat is None or \
+                remote_stat.size != os.path.getsize(local_path):
+            self.remote_put(local_path, remote_path)
+        return "%s %s" % (self.c.get("hpc_python_cmd", "python3"),
+                          shlex.quote(remote_path))
+
+    @reconnect_on_transport_error
+    def remote_put_many(self, files, parallel=1, codec="none"):
+        """
+        Upload many files at once over ``parallel`` SFTP channels.
+
+        :param files: List of (local path, remote path) tuples.
+        :param codec: "none" or "shuffle" to compress the files during the
+            transfer. They are decoded on the HPC afterwards.
+        """
+        for path in set(os.path.dirname(_i[1]) for _i in files):
+            self.remote_fs.invalidate(path)
+
+        if codec == "none":
+            return sftp_transfer.upload_files(
+                ssh_client=self.ssh_client, sftp_client=self.sftp_client,
+                files=files, parallel=parallel, log=self.add_log_entry)
+
+        encoded_files = [(_i, _j + ".shz") for _i, _j in files]
+        result = sftp_transfer.upload_files(
+            ssh_client=self.ssh_client, sftp_client=self.sftp_client,
+            files=encoded_files, parallel=parallel, log=self.add_log_entry,
+            codec=codec)
+
+        # Decode all files with a single process.
+        encoded = " ".join(shlex.quote(_i[1]) for _i in encoded_files)
+        cmd = "%s decode %s && rm %s" % (
+            self._get_remote_codec_command(),
+            " ".join("%s %s" % (shlex.quote(_i[1]), shlex.quote(_j[1]))
+                     for _i, _j in zip(encoded_files, files)),
+            encoded)
+        _start = time.time()
+        stdout, stderr = self._run_ssh_command(cmd)
+        assert not stderr, "Decoding on the HPC failed: %s" % "".join(stderr)
+        self.add_log_entry("Decoded %i files on the HPC in %.1f seconds." % (
+            len(files), time.time() - _start))
+        return result
+
+    @reconnect_on_transport_error
+    def remote_get_encoded(self, remotepath, localpath):
+        """
+        Download a file encoded with the shuffle codec on the fly on the
+        HPC and decode it locally.
+
+        Returns the size of the file and the number of transferred bytes.
+        """
+        cmd = "%s encode %s" % (self._get_remote_codec_command(),
+                                shlex.quote(remotepath))
+        _, stdout, stderr = self.ssh_client.exec_command(cmd)
+        channel = stdout.channel
+
+        decoder = shuffle_codec.Decoder()
+        size = 0
+        transferred = 0
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            # The remote process blocks once the SSH window is full so its
+            # stderr has to be read at the same time.
+            stderr = executor.submit(stderr.read)
+            with open(localpath, "wb") as fh:
+                while True:
+                    data = channel.recv(4 * 1024 * 1024)
+                    if not data:
+                        break
+                    transferred += len(data)
+                    data = decoder.feed(data)
+                    size += len(data)
+                    fh.write(data)
+            returncode = channel.recv_exit_status()
+            stderr = stderr.result().decode(errors="replace")
+
+        # A failed encoder might have sent a truncated but valid stream.
+        assert returncode == 0, \
+            "Encoding '%s' on the HPC failed with code %i: %s" % (
+                remotepath, returncode, stderr)
+        decoder.finish()
+        return size, transferred
+
     @retry(5)
+    @reconnect_on_transport_error
     def remote_get(self, remotepath, localpath):
         return self.sftp_client.get(remotepath=remotepath,
                                     localpath=localpath)
 
     @retry(5)
+    @reconnect_on_transport_error
     def remote_path_exists(self, path):
         """
         Check if the path exists on the remote machine.
         """
-        contents = self.remote_listdir(os.path.dirname(path))
-        return os.path.basename(path) in contents
+        return self.remote_fs.exists(path)
 
     def get_events(self):
         events = glob.glob(os.path.join(self.c["lasif_project"], "EVENTS",
@@ -149,6 +431,63 @@ class Task(metaclass=abc.ABCMeta):
 
         return events
 
+    def get_lasif_data_fingerprint(self):
+        """
+        Fingerprint of everything the LASIF caches are built from, per
+        event and station folder.
+        """
+        fingerprint = {}
+        for folder in ["DATA", "SYNTHETICS", "STATIONS"]:
+            for name, value in utils.directory_fingerprint(os.path.join(
+                    self.c["lasif_project"], folder)).items():
+                fingerprint["%s/%s" % (folder, name)] = value
+        return fingerprint
+
+    def build_lasif_caches(self):
+        """
+        Run `lasif build_all_caches --quick` if the LASIF data changed
+        since the caches have last been built.
+        """
+        fingerprint_file = os.path.join(self.context["working_dir"],
+                                        "lasif_cache_fingerprint.json")
+        try:
+            with open(fingerprint_file, "rt") as fh:
+                previous = json.load(fh)
+        except (FileNotFoundError, ValueError):
+            previous = None
+
+        fingerprint = self.get_lasif_data_fingerprint()
+
+        if previous is None:
+            reason = "no record of a previous build"
+        elif previous["fingerprint"] == fingerprint:
+            self.add_log_entry(
+                "LASIF data did not change since the caches have been "
+                "built at %s. Not building them again." % previous["time"])
+            return
+        else:
+            changed = sorted(
+                _i for _i in set(previous["fingerprint"]).union(fingerprint)
+                if previous["fingerprint"].get(_i) != fingerprint.get(_i))
+            reason = "%i changed folder(s) since the build at %s: %s" % (
+                len(changed), previous["time"], ", ".join(changed[:20]))
+            if len(changed) > 20:
+                reason += ", ..."
+
+        self.add_log_entry("Building LASIF caches due to %s." % reason)
+
+        returncode = self.run_lasif(["build_all_caches", "--quick"])
+
+        # Should be a good enough check.
+        assert returncode == 0, "Script return with code %i" % returncode
+
+        # Changes during the build will trigger the next build.
+        temp_filename = fingerprint_file + ".tmp"
+        with open(temp_filename, "wt") as fh:
+            json.dump({"time": str(datetime.datetime.now()),
+                       "fingerprint": fingerprint}, fh)
+        os.replace(temp_filename, fingerprint_file)
+
     def _assert_input_exists(self, input):
         assert input in self.inputs, "'%s' must be part of the inputs" % (
             input)
@@ -158,50 +497,244 @@ class Task(metaclass=abc.ABCMeta):
             fh.write("[%s] %s\n" % (str(datetime.datetime.now()), msg))
 
     def _init_ssh_and_stfp_clients(self):
-        # Load the config.
-        user_config_file = os.path.expanduser("~/.ssh/config")
-        ssh_config = paramiko.SSHConfig()
-        with open(user_config_file) as fh:
-            ssh_config.parse(fh)
-
-        # Use it to get host and user.
-        info = ssh_config.lookup(self.context["config"]["hpc_remote_host"])
-        # For some reason paramiko does not make it directly pluggable
-        # into the connect() method...
-        info["username"] = info["user"]
-        del info["user"]
-
-        self.ssh_client = paramiko.SSHClient()
-        # Should be safe enough in our controlled environment.
-        self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.ssh_client.load_system_host_keys()
-        self.ssh_client.connect(
-            username=info["username"],
-            hostname=info["hostname"],
-            # Two minutes should be good for most things.
-            timeout=120)
-
-        self.sftp_client = self.ssh_client.open_sftp()
+        # Connections are shared between all tasks of a worker process.
+        host = self.context["config"]["hpc_remote_host"]
+        pool = connection_pool.pool
 
-        self.add_log_entry(
-            "Successfully initialized SSH and SFTP connection to %s@%s" % (
-                info["username"], info["hostname"]))
+        self.ssh_client, self.sftp_client = pool.get_clients(host)
+        # Remote metadata is cached per task.
+        self.remote_fs = remote_filesystem.RemoteFileSystem(
+            ssh_client=self.ssh_client, sftp_client=self.sftp_client,
+            ttl=self.c.get("remote_cache_ttl", 60.0))
 
-    def __del__(self):
-        # Close ssh and sftp clients in the destructor.
-        if hasattr(self, "ssh_client"):
-            self.ssh_client.close()
-            self.sftp_client.close()
+        self.add_log_entry(
+            "Successfully initialized SSH and SFTP connection to %s@%s "
+            "(connection pool hits: %i, misses: %i, reconnects: %i)" % (
+                pool.get_user_and_hostname(host) + (
+                    pool.statistics["hits"], pool.statistics["misses"],
+                    pool.statistics["reconnects"])))
 
     def _run_ssh_command(self, cmd):
+        # Reconnect if necessary but never automatically rerun a command
+        # after the connection died. It might for example have submitted an
+        # expensive job.
+        if not connection_pool.pool.is_healthy(self.c["hpc_remote_host"]):
+            self._init_ssh_and_stfp_clients()
+
         self.add_log_entry("Executing command over SSH: '%s'" % cmd)
         _, stdout, stderr = self.ssh_client.exec_command(cmd)
         # Force synchronous execution.
         stdout = stdout.readlines()
         stderr = stderr.readlines()
+        # The command might have changed anything on the remote side.
+        self.remote_fs.invalidate()
         return stdout, stderr
 
-    def _run_external_script(self, cwd, cmd, retry=1):
+    def _stream_ssh_command_to_file(self, cmd, filename,
+                                    chunk_size=4 * 1024 * 1024):
+        """
+        Run a command over SSH and directly write its stdout to a local
+        file without buffering it in memory.
+
+        Returns the exit status of the command. stderr is appended to the
+        task's stderr file.
+        """
+        if not connection_pool.pool.is_healthy(self.c["hpc_remote_host"]):
+            self._init_ssh_and_stfp_clients()
+
+        self.add_log_entry("Streaming output of command over SSH to '%s': "
+                           "'%s'" % (filename, cmd))
+        _, stdout, stderr = self.ssh_client.exec_command(cmd)
+        channel = stdout.channel
+
+        start = time.time()
+        last_log = start
+        transferred = 0
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            # The remote process blocks once the SSH window is full so its
+            # stderr has to be read at the same time.
+            stderr = executor.submit(stderr.read)
+            with open(filename, "wb") as fh:
+                while True:
+                    data = channel.recv(chunk_size)
+                    if not data:
+                        break
+                    fh.write(data)
+                    transferred += len(data)
+
+                    if time.time() - last_log > 60:
+                        last_log = time.time()
+                        self.add_log_entry(
+                            "Received %s (%s/s)" % (
+                                sftp_transfer.format_size(transferred),
+                                sftp_transfer.format_size(
+                                    transferred / (last_log - start))))
+            returncode = channel.recv_exit_status()
+            stderr = stderr.result()
+
+        with open(self.stderr, "ab") as fh:
+            fh.write(stderr)
+        self.remote_fs.invalidate()
+
+        runtime = time.time() - start
+        self.add_log_entry("Received %s in %.1f seconds (%s/s)." % (
+            sftp_transfer.format_size(transferred), runtime,
+            sftp_transfer.format_size(transferred / max(runtime, 1E-6))))
+        return returncode
+
+    def stream_and_unpack_waveforms(self, hpc_agere_fwd_job_id, filename,
+                                    events=None):
+        """
+        Stream the waveforms of a forward run from the HPC and unpack them
+        to the LASIF project.
+
+        :param hpc_agere_fwd_job_id: The agere job number.
+        :param filename: Local temporary tar file.
+        :param events: Only transfer the waveforms of these events.
+        """
+        waveform_directory = os.path.join(
+            self.c["hpc_agere_project"], "__WAVEFORMS", hpc_agere_fwd_job_id)
+        if events is None:
+            paths = [hpc_agere_fwd_job_id]
+        else:
+            paths = [os.path.join(hpc_agere_fwd_job_id, _i) for _i in events]
+
+        # Same layout as the tar files created by agere.
+        cmd = "tar -C %s -cf - %s" % (
+            shlex.quote(os.path.dirname(waveform_directory)),
+            " ".join(shlex.quote(_i) for _i in paths))
+        returncode = self._stream_ssh_command_to_file(cmd=cmd,
+                                                      filename=filename)
+        assert returncode == 0, "tar return with code %i" % returncode
+
+        cmd = [self.c["agere_cmd"],
+               "unpack_waveforms",
+               "--iteration-name=%s" % self.inputs["iteration_name"],
+               "--lasif-project=%s" % self.c["lasif_project"],
+               filename]
+        returncode = self._run_external_script(cwd=".", cmd=cmd)
+
+        # Should be a good enough check.
+        assert returncode == 0, "Script return with code %i" % returncode
+
+        # No need to keep a second copy of the waveforms around.
+        os.remove(filename)
+
+    def check_remote_waveforms(self, hpc_agere_fwd_job_id):
+        """
+        Make sure waveforms for all events of the forward run exist on the
+        HPC.
+
+        Returns the remote waveform directory of the run.
+        """
+        waveform_directory = os.path.join(
+            self.c["hpc_agere_project"], "__WAVEFORMS", hpc_agere_fwd_job_id)
+
+        # Check that waveforms for enough events are present.
+        event_folders = self.remote_listdir(waveform_directory)
+        assert len(event_folders) == self.c["number_of_events"], \
+            "Run should have resulted in '%s' events." % \
+            self.c["number_of_events"]
+
+        # Also check they all actually have waveforms.
+        stdout, stderr = self._run_ssh_command(
+            'du %s/*' % waveform_directory)
+        assert not stderr, "stderr during waveform checkign: %s" % stderr
+        # Make sure to remove any empty lines.
+        stdout = [_i.strip() for _i in stdout if _i.strip()]
+        assert len(stdout) == self.c["number_of_events"], "Should not happen!"
+        # Random threshold of a thousand bytes.
+        stdout = [_i for _i in stdout if int(_i.strip().split()[0]) < 1000]
+        assert not stdout, "Events %s don't have enough waveform data!" % (
+            ", ".join(_i.strip().split()[1] for _i in stdout))
+
+        return waveform_directory
+
+    @property
+    def hpc_job_monitor(self):
+        """
+        Monitor of the agere runs shared with all other tasks.
+        """
+        return hpc_monitor.HPCJobMonitor(
+            cache_filename=os.path.join(self.context["working_dir"],
+                                        "hpc_job_status.json"),
+            query_function=lambda: self._run_ssh_command(
+                "%s status" % self.c["hpc_agere_cmd"])[0])
+
+    def wait_for_hpc_job(self, job_id, walltime_per_event):
+        """
+        Wait condition for an agere run that has just been submitted.
+
+        :param job_id: The agere job number.
+        :param walltime_per_event: The walltime per event in hours.
+        """
+        now = time.time()
+        expected_end_time = now + self.get_expected_hpc_runtime(
+            walltime_per_event)
+        return WaitCondition(
+            check="check_hpc_job",
+            interval=self.hpc_job_monitor.get_poll_interval(
+                expected_end_time),
+            kwargs={"job_id": job_id, "expected_end_time": expected_end_time,
+                    "not_before": now})
+
+    def check_hpc_job(self, job_id, expected_end_time, not_before):
+        """
+        Check if the agere run finished. The check interval adapts to the
+        expected end time.
+        """
+        monitor = self.hpc_job_monitor
+        interval = monitor.get_poll_interval(expected_end_time)
+        # Status queried before the run was submitted does not know it.
+        status = monitor.get_status(job_id, max_age=interval,
+                                    not_before=not_before)
+        self.add_log_entry("Current status of remote job: %s" % status)
+
+        if status == "FINISHED":
+            return True
+
+        return WaitCondition(
+            check="check_hpc_job", interval=interval,
+            kwargs={"job_id": job_id, "expected_end_time": expected_end_time,
+                    "not_before": not_before})
+
+    def get_expected_hpc_runtime(self, walltime_per_event):
+        """
+        Expected runtime of an agere run in seconds.
+
+        :param walltime_per_event: The walltime per event in hours.
+        """
+        batches = -(-self.c["number_of_events"] // self.c["parallel_events"])
+        return walltime_per_event * batches * 3600.0
+
+    def _write_script_header(self, stdout_file, starttime):
+        with open(stdout_file, "ab") as stdout:
+            stdout.write(b"\n\n\n\n\n================================\n")
+            stdout.write(b"\n================================\n")
+            stdout.write(b"STARTTIME: %b\n" % str(starttime).encode())
+            stdout.write(b"---------------------\n")
+            stdout.write(b"STDOUT START\n")
+            stdout.write(b"---------------------\n")
+
+    def _write_script_footer(self, stdout_file, cmd, pid, returncode,
+                             runtime):
+        with open(stdout_file, "at") as fh:
+            fh.write("\n---------------------\n")
+            fh.write("STDOUT END\n")
+            fh.write("---------------------\n")
+            fh.write("DONE\n")
+            fh.write("PID: %i\n" % pid)
+            fh.write("RETURNCODE: %i\n" % returncode)
+            fh.write("CMD: %s\n" % (str(cmd)))
+            fh.write("RUNTIME: %.3f seconds\n" % runtime)
+            fh.write("ENDTIME: %s\n" % datetime.datetime.now())
+
+    def _run_external_script(self, cwd, cmd, retry=1, stdout=None,
+                             stderr=None):
+        # Defaults to the stdout and stderr files of the task.
+        stdout_file = stdout if stdout is not None else self.stdout
+        stderr_file = stderr if stderr is not None else self.stderr
+
         for _i in range(retry):
             _i += 1
             starttime = datetime.datetime.now()
@@ -212,33 +745,22 @@ class Task(metaclass=abc.ABCMeta):
                 cmd, cwd))
 
             # start the daemon main loop
-            with open(self.stdout, "ab") as stdout:
-                stdout.write(b"\n\n\n\n\n================================\n")
-                stdout.write(b"\n================================\n")
-                stdout.write(b"STARTTIME: %b\n" % str(starttime).encode())
-                stdout.write(b"---------------------\n")
-                stdout.write(b"STDOUT START\n")
-                stdout.write(b"---------------------\n")
-                with open(self.stderr, "ab") as stderr:
-                    p = subprocess.Popen(cmd, cwd=cwd,
-                                         stdout=stdout,
-                                         stderr=stderr)
+            self._write_script_header(stdout_file, starttime)
+            with open(stdout_file, "ab") as stdout, \
+                    open(stderr_file, "ab") as stderr:
+                p = subprocess.Popen(cmd, cwd=cwd,
+                                     stdout=stdout,
+                                     stderr=stderr)
 
             p.wait()
 
-            endtime = datetime.datetime.now()
-            _end = time.time()
+            # Might have been rsync/scp to the remote host.
+            if "remote_fs" in self.__dict__:
+                self.remote_fs.invalidate()
 
-            with open(self.stdout, "at") as fh:
-                fh.write("\n---------------------\n")
-                fh.write("STDOUT END\n")
-                fh.write("---------------------\n")
-                fh.write("DONE\n")
-                fh.write("PID: %i\n" % p.pid)
-                fh.write("RETURNCODE: %i\n" % p.returncode)
-                fh.write("CMD: %s\n" % (str(cmd)))
-                fh.write("RUNTIME: %.3f seconds\n" % (_end - _start))
-                fh.write("ENDTIME: %s\n" % endtime)
+            self._write_script_footer(
+                stdout_file, cmd=cmd, pid=p.pid, returncode=p.returncode,
+                runtime=time.time() - _start)
 
             # Return if the retcode is 0 or if we reached the maximum number
             # of retries...
@@ -251,6 +773,382 @@ class Task(metaclass=abc.ABCMeta):
         # Should not be reachable but let's be safe.
         return p.returncode
 
+    def get_worker_command(self, tool):
+        """
+        Command starting a warm worker of a tool.
+
+        :param tool: Either "lasif" or "agere".
+        """
+        python_cmd = self.c.get("%s_python_cmd" % tool)
+        if python_cmd is not None:
+            python_cmd = shlex.split(python_cmd)
+        else:
+            python_cmd = warm_worker.get_interpreter(
+                self.c["%s_cmd" % tool]) or [sys.executable]
+
+        command = python_cmd + [os.path.abspath(warm_worker.__file__)]
+        if tool == "lasif":
+            command += ["--entry-point=lasif.scripts.lasif_cli:main",
+                        "--lasif-project=%s" % self.c["lasif_project"]]
+        else:
+            command += ["--script=%s" % self.c["%s_cmd" % tool]]
+            # Not matplotlib.pyplot as that would choose the backend before
+            # agere does.
+            command += ["--preload=%s" % _i for _i in
+                        ["numpy", "h5py", "matplotlib"]]
+        return command
+
+    def get_worker_pool(self, tool):
+        """
+        The pool of warm workers of a tool or None if disabled.
+
+        :param tool: Either "lasif" or "agere".
+        """
+        size = self.c.get("%s_workers" % tool, 0)
+        if not size:
+            return None
+        return warm_worker.WarmWorkerPool(
+            name=tool, size=size, log_dir=self.context["working_dir"],
+            command=self.get_worker_command(tool))
+
+    def _run_tool(self, tool, args, cwd, stdout=None, stderr=None):
+        """
+        Run a command of a tool in one of its warm workers and fall back to
+        a new process if no worker is enabled or available.
+        """
+        cmd = [self.c["%s_cmd" % tool]] + list(args)
+        pool = self.get_worker_pool(tool)
+        if pool is None:
+            return self._run_external_script(
+                cwd=cwd, cmd=cmd, stdout=stdout, stderr=stderr)
+
+        stdout_file = stdout if stdout is not None else self.stdout
+        stderr_file = stderr if stderr is not None else self.stderr
+
+        self.add_log_entry("Sending cmd '%s' to a %s worker ..." % (cmd,
+                                                                   tool))
+        self._write_script_header(stdout_file, datetime.datetime.now())
+        _start = time.time()
+        reply = pool.run(prog=tool, args=args, cwd=cwd, stdout=stdout_file,
+                         stderr=stderr_file, log=self.add_log_entry)
+        if reply is None:
+            self.add_log_entry("Running the %s cmd in a new process." % tool)
+            return self._run_external_script(
+                cwd=cwd, cmd=cmd, stdout=stdout, stderr=stderr)
+        runtime = time.time() - _start
+
+        self._write_script_footer(
+            stdout_file, cmd=cmd, pid=reply["pid"],
+            returncode=reply["returncode"], runtime=runtime)
+
+        msg = "%s worker %i finished '%s' with return code %i in %.2f " \
+            "seconds (%.2f seconds in the command)." % (
+                tool, reply["pid"], args[0], reply["returncode"], runtime,
+                reply["runtime"])
+        if reply["started_worker"]:
+            msg += " Starting the worker took %.2f seconds." % (
+                reply["startup"])
+        else:
+            # A new process would have to start the interpreter and do all
+            # the imports first - this is what the worker measured for its
+            # own startup.
+            msg += " Saved about %.2f seconds of process startup." % (
+                reply["startup"] - (runtime - reply["runtime"]))
+        self.add_log_entry(msg)
+        return reply["returncode"]
+
+    def run_lasif(self, args, stdout=None, stderr=None):
+        """
+        Run a LASIF command in the LASIF project and return its return code.
+
+        The command is sent to one of up to ``lasif_workers`` (from the
+        config file, defaults to 0) warm LASIF processes which already
+        imported LASIF and opened the project. It falls back to running
+        ``lasif_cmd`` in a new process if no worker is enabled or
+        available.
+
+        :param args: The arguments of the LASIF command, e.g.
+            ``["build_all_caches", "--quick"]``.
+        :param stdout: File the stdout is appended to. Defaults to the
+            stdout file of the task.
+        :param stderr: File the stderr is appended to. Defaults to the
+            stderr file of the task.
+        """
+        return self._run_tool("lasif", args=args,
+                              cwd=self.c["lasif_project"], stdout=stdout,
+                              stderr=stderr)
+
+    def run_agere(self, args, cwd=".", stdout=None, stderr=None):
+        """
+        Run a local agere command and return its return code.
+
+        Same as run_lasif() but with up to ``agere_workers`` warm agere
+        processes which already imported numpy, h5py, and matplotlib.
+        """
+        return self._run_tool("agere", args=args, cwd=cwd, stdout=stdout,
+                              stderr=stderr)
+
+    def _run_tool_batch(self, tool, cwd, cmds, batch_name):
+        """
+        Run many commands of a tool one after another in a single process
+        so the interpreter starts, the imports happen, and every HDF5 file
+        is opened only once.
+
+        The batch is sent to a warm worker if enabled and available.
+        Otherwise a new process just runs this batch. Each command writes
+        to its own stdout and stderr file in the working directory.
+
+        :param tool: Either "lasif" or "agere".
+        :param cwd: The working directory of all commands.
+        :param cmds: Dictionary name -> arguments of the command of the
+            tool.
+        :param batch_name: Name of the batch, unique within the task.
+
+        Returns a dictionary name -> return code.
+        """
+        names = sorted(cmds.keys())
+        requests = []
+        for name in names:
+            filename = os.path.join(self.working_dir, name)
+            requests.append(warm_worker.make_request(
+                prog=tool, args=cmds[name], cwd=cwd,
+                stdout=filename + ".stdout", stderr=filename + ".stderr"))
+            self._write_script_header(filename + ".stdout",
+                                      datetime.datetime.now())
+
+        _start = time.time()
+        replies = None
+        pool = self.get_worker_pool(tool)
+        if pool is not None:
+            self.add_log_entry("Sending %i %s cmds to a %s worker ..." % (
+                len(names), tool, tool))
+            reply = pool.run_batch(requests, log=self.add_log_entry)
+            if reply is not None:
+                replies = reply["replies"]
+
+        if replies is None:
+            batch_file = os.path.join(self.working_dir,
+                                      "%s_batch.json" % batch_name)
+            replies_file = os.path.join(self.working_dir,
+                                        "%s_replies.json" % batch_name)
+            with open(batch_file, "wt") as fh:
+                json.dump(requests, fh)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(replies_file)
+            returncode = self._run_external_script(
+                cwd=cwd, cmd=self.get_worker_command(tool) + [
+                    "--batch=%s" % batch_file, "--replies=%s" % replies_file])
+            if returncode != 0 or not os.path.exists(replies_file):
+                self.add_log_entry(
+                    "Running %i %s cmds in a single process failed with "
+                    "return code %i." % (len(names), tool, returncode))
+                return {_i: returncode or 1 for _i in names}
+            with open(replies_file, "rt") as fh:
+                replies = json.load(fh)
+
+        returncodes = {}
+        for name, reply in zip(names, replies):
+            self._write_script_footer(
+                os.path.join(self.working_dir, name + ".stdout"),
+                cmd=[self.c["%s_cmd" % tool]] + cmds[name], pid=reply["pid"],
+                returncode=reply["returncode"], runtime=reply["runtime"])
+            self.add_log_entry(
+                "Script '%s' finished with return code %i in %.1f "
+                "seconds." % (name, reply["returncode"], reply["runtime"]))
+            returncodes[name] = reply["returncode"]
+        self.add_log_entry("Ran %i %s cmds in a single process in %.1f "
+                           "seconds." % (len(names), tool,
+                                         time.time() - _start))
+        return returncodes
+
+    def _run_external_scripts(self, cwd, cmds, parallel=1, retries=1,
+                              callback=None, tool=None, retry_delay=0):
+        """
+        Run many external scripts with at most ``parallel`` of them at the
+        same time.
+
+        Each script writes to its own stdout and stderr file in the working
+        directory. Failed scripts are retried individually up to
+        ``retries`` times.
+
+        :param cwd: The working directory of all scripts.
+        :param cmds: Dictionary name -> command.
+        :param parallel: The maximum number of concurrently running
+            scripts.
+        :param retries: The number of attempts per script.
+        :param callback: Optional function called with the name and the
+            return code after each finished script.
+        :param tool: "lasif" or "agere" if the commands are just the
+            arguments of commands of that tool. They are then run with
+            run_lasif() or run_agere().
+        :param retry_delay: Seconds to wait before retrying the failed
+            scripts, e.g. to let a network connection recover.
+
+        Returns a dictionary name -> return code of its last attempt.
+        """
+        def _run(name):
+            filename = os.path.join(self.working_dir, name)
+            _start = time.time()
+            if tool == "lasif":
+                returncode = self.run_lasif(
+                    args=cmds[name], stdout=filename + ".stdout",
+                    stderr=filename + ".stderr")
+            elif tool == "agere":
+                returncode = self.run_agere(
+                    args=cmds[name], cwd=cwd, stdout=filename + ".stdout",
+                    stderr=filename + ".stderr")
+            else:
+                returncode = self._run_external_script(
+                    cwd=cwd, cmd=cmds[name], stdout=filename + ".stdout",
+                    stderr=filename + ".stderr")
+            self.add_log_entry(
+                "Script '%s' finished with return code %i in %.1f "
+                "seconds." % (name, returncode, time.time() - _start))
+            return returncode
+
+        returncodes = {}
+        todo = sorted(cmds.keys())
+        for attempt in range(1, retries + 1):
+            with concurrent.futures.ThreadPoolExecutor(parallel) as executor:
+                futures = {executor.submit(_run, _i): _i for _i in todo}
+                for future in concurrent.futures.as_completed(futures):
+                    name = futures[future]
+                    returncodes[name] = future.result()
+                    if callback is not None:
+                        callback(name, returncodes[name])
+
+            todo = [_i for _i in todo if returncodes[_i] != 0]
+            if not todo:
+                break
+            self.add_log_entry("%i script(s) failed: %s" % (
+                len(todo), ", ".join(todo)))
+            if attempt < retries:
+                time.sleep(retry_delay)
+
+        return returncodes
+
+    def _get_plot_cache_filename(self, cmd, inputs, output, input_hashes):
+        """
+        Filename of a plot in the plot cache.
+
+        It is keyed by the content of the input files and the command
+        without the output path. The inputs must include every file the
+        plot reads. ``input_hashes`` is used to only hash each input once.
+        """
+        checksum = hashlib.sha256()
+        for path in inputs:
+            if path not in input_hashes:
+                input_hashes[path] = utils.content_hash(path)
+            checksum.update(input_hashes[path].encode())
+        checksum.update(json.dumps(
+            [_i.replace(output, os.path.basename(output))
+             for _i in cmd]).encode())
+        key = checksum.hexdigest()
+
+        return os.path.join(self.context["output_folders"]["plot_cache"],
+                            key[:2], key + os.path.splitext(output)[1])
+
+    def _prune_plot_cache(self):
+        """
+        Remove the least recently used plots from the plot cache until it
+        is no larger than ``plot_cache_size`` (in MB, from the config file,
+        defaults to 1000).
+        """
+        max_size = self.c.get("plot_cache_size", 1000) * 1024 ** 2
+
+        entries = []
+        for root, _, files in os.walk(
+                self.context["output_folders"]["plot_cache"]):
+            for filename in files:
+                filename = os.path.join(root, filename)
+                # Might just have been removed by another job.
+                with contextlib.suppress(FileNotFoundError):
+                    stat = os.stat(filename)
+                    entries.append((stat.st_mtime, stat.st_size, filename))
+
+        size = sum(_i[1] for _i in entries)
+        removed = 0
+        for _, file_size, filename in sorted(entries):
+            if size <= max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(filename)
+            size -= file_size
+            removed += 1
+
+        if removed:
+            self.add_log_entry("Removed %i plots from the plot cache. It now "
+                               "has %s." % (removed,
+                                            sftp_transfer.format_size(size)))
+
+    def _run_plotting_scripts(self, cwd, cmds, inputs, outputs, tool):
+        """
+        Render the plots of a task.
+
+        Plots that have been rendered before from the same inputs and with
+        the same command are hard linked from the plot cache. All other
+        plots are rendered by a single process. With ``plotting_processes``
+        (from the config file, defaults to one) larger than one, they are
+        split between that many processes running at the same time.
+
+        :param cwd: The working directory of all commands.
+        :param cmds: Dictionary plot name -> arguments of the plotting
+            command of the tool.
+        :param inputs: Dictionary plot name -> list of all files or folders
+            read by the plot.
+        :param outputs: Dictionary plot name -> output filename of the plot.
+            Must also be part of the command.
+        :param tool: Either "lasif" or "agere".
+        """
+        _start = time.time()
+
+        cache_filenames = {}
+        input_hashes = {}
+        todo = {}
+        for name, cmd in cmds.items():
+            cache_filenames[name] = self._get_plot_cache_filename(
+                cmd=[self.c["%s_cmd" % tool]] + cmd, inputs=inputs[name],
+                output=outputs[name], input_hashes=input_hashes)
+            try:
+                # Marks the plot as recently used.
+                os.utime(cache_filenames[name])
+            except FileNotFoundError:
+                todo[name] = cmd
+                continue
+            _link_or_copy(cache_filenames[name], outputs[name])
+            self.add_log_entry("Plot '%s' found in the plot cache." % name)
+
+        # Plots are distributed round robin over the processes.
+        names = sorted(todo.keys())
+        processes = min(self.c.get("plotting_processes", 1), len(names))
+        batches = [{_j: todo[_j] for _j in names[_i::processes]}
+                   for _i in range(processes)]
+        if batches:
+            with concurrent.futures.ThreadPoolExecutor(processes) as executor:
+                futures = [executor.submit(
+                    self._run_tool_batch, tool=tool, cwd=cwd, cmds=batch,
+                    batch_name="plots_%i" % _i)
+                    for _i, batch in enumerate(batches)]
+                for future in futures:
+                    future.result()
+
+        for name in todo:
+            if not os.path.exists(outputs[name]):
+                continue
+            os.makedirs(os.path.dirname(cache_filenames[name]),
+                        exist_ok=True)
+            # Replace atomically so concurrent jobs never see partial files.
+            temp_filename = cache_filenames[name] + ".tmp%i" % os.getpid()
+            _link_or_copy(outputs[name], temp_filename)
+            os.replace(temp_filename, cache_filenames[name])
+        if todo:
+            self._prune_plot_cache()
+
+        self.add_log_entry(
+            "Rendered %i plots and took %i from the plot cache in %.1f "
+            "seconds." % (len(todo), len(cmds) - len(todo),
+                          time.time() - _start))
+
     def copy_blockfiles(self, target_dir):
         """
         The blockfiles constantly have to copied. Thus this is a class method.
@@ -261,6 +1159,55 @@ class Task(metaclass=abc.ABCMeta):
             filename = os.path.basename(file)
             shutil.copy2(file, os.path.join(target_dir, filename))
 
+    def get_boxfile(self, model_filename):
+        """
+        Extract the boxfile of an HDF5 model and return its filename.
+
+        The boxfile is read from the model once and cached in the working
+        directory of the flow so all further tasks can reuse it.
+
+        :param model_filename: The HDF5 model.
+        """
+        stat = os.stat(model_filename)
+        cache_dir = os.path.join(self.context["working_dir"], "boxfiles")
+        boxfile = os.path.join(cache_dir, "%s_%i_%i.boxfile" % (
+            os.path.splitext(os.path.basename(model_filename))[0],
+            stat.st_size, stat.st_mtime_ns))
+        if os.path.exists(boxfile):
+            return boxfile
+
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_filename = boxfile + ".tmp%i" % os.getpid()
+        try:
+            data = utils.read_hdf5_dataset(model_filename, "_meta/boxfile")
+        except ImportError:
+            self.add_log_entry("h5py is not installed. Extracting the "
+                               "boxfile with h5dump.")
+            returncode = self._run_external_script(cwd=".", cmd=[
+                "h5dump", "-d", "_meta/boxfile", "-b", "-o", temp_filename,
+                model_filename])
+            assert returncode == 0, \
+                "h5dump returned with code %i" % returncode
+        else:
+            with open(temp_filename, "wb") as fh:
+                fh.write(data)
+        os.replace(temp_filename, boxfile)
+        self.add_log_entry("Extracted the boxfile of '%s'." % model_filename)
+        return boxfile
+
+    def copy_boxfile(self, target_dir):
+        """
+        Copy the boxfile of the HDF5 model of the current iteration to a
+        directory if it does not already have one.
+
+        :param target_dir: The target directory.
+        """
+        filename = os.path.join(target_dir, "boxfile")
+        if os.path.exists(filename):
+            return filename
+        _link_or_copy(self.get_boxfile(self.hdf5_model_path), filename)
+        return filename
+
     @property
     def model_name(self):
         return "%s_model" % self.inputs["iteration_name"]
@@ -292,6 +1239,13 @@ class Task(metaclass=abc.ABCMeta):
             self.context["output_folders"]["hdf5_gradients"],
             "%s%s_gradient.h5" % (iteration_name, tag))
 
+    @property
+    def lasif_config_file(self):
+        """
+        The config file of the LASIF project.
+        """
+        return os.path.join(self.c["lasif_project"], "config.xml")
+
     @property
     def binary_model_path(self):
         """
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import sys
 import traceback
@@ -26,6 +27,76 @@ def assert_files_dont_exist(folder, file_names):
             "File '%s' already exists." % filename)
 
 
+def content_hash(path):
+    """
+    SHA-256 of the content of a file or of all files in a folder.
+
+    For folders the relative paths are part of the hash.
+    """
+    checksum = hashlib.sha256()
+    if os.path.isdir(path):
+        filenames = []
+        for root, _, files in os.walk(path):
+            filenames.extend(os.path.join(root, _i) for _i in files)
+        filenames = sorted(filenames)
+    else:
+        filenames = [path]
+
+    for filename in filenames:
+        checksum.update(os.path.relpath(filename, path).encode())
+        with open(filename, "rb") as fh:
+            for chunk in iter(lambda: fh.read(16 * 1024 * 1024), b""):
+                checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def read_hdf5_dataset(filename, dataset):
+    """
+    Raw bytes of a single dataset of an HDF5 file in native byte order -
+    the same as `h5dump -d DATASET -b -o ...`.
+
+    Only this dataset is read and not the rest of the file. Raises an
+    ImportError if h5py is not installed.
+    """
+    # Importing h5py and numpy is slow and only a few tasks need it.
+    import h5py
+
+    with h5py.File(filename, "r") as f:
+        data = f[dataset][()]
+    if isinstance(data, str):
+        return data.encode()
+    if isinstance(data, bytes):
+        return data
+    # h5py keeps the byte order of the file.
+    return data.astype(data.dtype.newbyteorder("="), copy=False).tobytes()
+
+
+def directory_fingerprint(folder):
+    """
+    Cheap fingerprint of the content of all direct subfolders of a folder.
+
+    Returns a dictionary subfolder name -> [number of files, total size,
+    latest modification time in ns] without reading any file.
+    """
+    fingerprint = {}
+    if not os.path.isdir(folder):
+        return fingerprint
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if not os.path.isdir(path):
+            continue
+        count, size, mtime = 0, 0, os.stat(path).st_mtime_ns
+        for root, _, files in os.walk(path):
+            mtime = max(mtime, os.stat(root).st_mtime_ns)
+            for filename in files:
+                stat = os.stat(os.path.join(root, filename))
+                count += 1
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime_ns)
+        fingerprint[name] = [count, size, mtime]
+    return fingerprint
+
+
 def collect_traceback(traceback_limit):
         # Extract traceback from the exception.
         exc_info = sys.exc_info()
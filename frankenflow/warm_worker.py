@@ -0,0 +1,553 @@
+"""
+Long-lived worker processes running the commands of a Python command line
+tool without paying for the interpreter startup and the imports every time.
+
+Each worker listens on a Unix socket and runs one command at a time in
+its own process by calling the entry point of the tool with the given
+arguments. The stdout and stderr of the command are directly written to
+the files given with each command. Workers exit after being idle for a
+while.
+
+A batch of commands is run one after another in the same process with
+each HDF5 file they read opened only once, either by a worker or by a
+process running just this batch with ``--batch``.
+
+Only depends on the standard library as it is run with the interpreter of
+the tool which might not have frankenflow installed:
+
+    python warm_worker.py --socket=SOCKET --lock=LOCK \\
+        --entry-point=lasif.scripts.lasif_cli:main
+    python warm_worker.py --socket=SOCKET --lock=LOCK \\
+        --script=/path/to/bin/agere --preload=numpy --preload=h5py
+    python warm_worker.py --batch=BATCH.json --replies=REPLIES.json \\
+        --script=/path/to/bin/agere --preload=numpy --preload=h5py
+"""
+import argparse
+import contextlib
+import fcntl
+import functools
+import hashlib
+import importlib
+import json
+import os
+import runpy
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+
+# LASIF commands that do not change the project so an open project can be
+# used for the next command.
+LASIF_READ_ONLY_COMMANDS = {"compare_misfits", "finalize_adjoint_sources",
+                            "plot_kernel", "plot_model",
+                            "select_all_windows"}
+
+
+def get_interpreter(script):
+    """
+    The interpreter command of a script from its shebang line or None if
+    it does not have one.
+    """
+    try:
+        with open(script, "rb") as fh:
+            line = fh.readline(1024).decode(errors="replace")
+    except OSError:
+        return None
+    if not line.startswith("#!"):
+        return None
+    return shlex.split(line[2:].strip()) or None
+
+
+def make_request(prog, args, cwd, stdout, stderr):
+    """
+    A single command for a worker.
+
+    :param prog: Program name the command sees in ``sys.argv[0]``.
+    :param args: The command line arguments.
+    :param cwd: Working directory of the command.
+    :param stdout: File the stdout of the command is appended to.
+    :param stderr: File the stderr of the command is appended to.
+    """
+    return {"prog": prog, "args": list(args), "cwd": os.path.abspath(cwd),
+            "stdout": os.path.abspath(stdout),
+            "stderr": os.path.abspath(stderr)}
+
+
+class WarmWorkerPool():
+    """
+    Client side of a pool of warm workers.
+
+    Workers are started on first use and shared by all processes using a
+    pool with the same name, command, and log directory. Each worker is
+    guarded by a lock file which is held for the whole duration of a
+    command so a worker is never used by two clients at the same time.
+
+    :param name: Name of the pool, used for the socket and log files.
+    :param command: Command starting a worker, e.g. the interpreter of the
+        tool, this file, and the entry point.
+    :param size: Maximum number of workers.
+    :param log_dir: Directory for the log files of the workers.
+    :param startup_timeout: Seconds to wait for a new worker to accept
+        commands.
+    :param idle_timeout: Seconds after which an unused worker exits.
+    """
+    def __init__(self, name, command, size, log_dir, startup_timeout=120.0,
+                 idle_timeout=3600.0):
+        self.name = name
+        self.command = list(command)
+        self.size = size
+        self.log_dir = log_dir
+        self.startup_timeout = startup_timeout
+        self.idle_timeout = idle_timeout
+
+        # Unix socket paths are short so they live in the temp directory.
+        key = hashlib.sha1(json.dumps(
+            [name, self.command, os.path.abspath(log_dir)]).encode())
+        self._base = os.path.join(
+            tempfile.gettempdir(),
+            "frankenflow_%s_%s" % (name, key.hexdigest()[:12]))
+
+    def _socket_filename(self, index):
+        return "%s_%i.sock" % (self._base, index)
+
+    def _lock_filename(self, index):
+        return "%s_%i.lock" % (self._base, index)
+
+    def _log_filename(self, index):
+        return os.path.join(self.log_dir, "%s_worker_%i.log" % (self.name,
+                                                                index))
+
+    @contextlib.contextmanager
+    def _acquire(self):
+        """
+        Lock the first idle worker and yield its index or None if all
+        workers are busy.
+        """
+        for index in range(self.size):
+            fh = open(self._lock_filename(index), "a")
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fh.close()
+                continue
+            try:
+                yield index
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+                fh.close()
+            return
+        yield None
+
+    def _connect(self, index):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self._socket_filename(index))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _start(self, index, log):
+        """
+        Start a worker and connect to it. Returns None if it did not come
+        up.
+        """
+        socket_filename = self._socket_filename(index)
+        # A left over socket of a worker that died.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(socket_filename)
+
+        cmd = self.command + [
+            "--socket=%s" % socket_filename,
+            "--lock=%s" % self._lock_filename(index),
+            "--started=%f" % time.time(),
+            "--idle-timeout=%f" % self.idle_timeout]
+        log("Starting %s worker %i: %s" % (self.name, index, cmd))
+        with open(self._log_filename(index), "ab") as fh:
+            p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=fh,
+                                 stderr=subprocess.STDOUT,
+                                 start_new_session=True)
+
+        start = time.time()
+        while time.time() - start < self.startup_timeout:
+            if p.poll() is not None:
+                log("%s worker %i exited with code %i during startup. See "
+                    "'%s'." % (self.name, index, p.returncode,
+                               self._log_filename(index)))
+                return None
+            try:
+                return self._connect(index)
+            except OSError:
+                time.sleep(0.1)
+
+        log("%s worker %i did not start within %.0f seconds." % (
+            self.name, index, self.startup_timeout))
+        p.kill()
+        return None
+
+    def run(self, prog, args, cwd, stdout, stderr, log):
+        """
+        Run a command in one of the workers.
+
+        :param prog: Program name the command sees in ``sys.argv[0]``.
+        :param args: The command line arguments.
+        :param cwd: Working directory of the command.
+        :param stdout: File the stdout of the command is appended to.
+        :param stderr: File the stderr of the command is appended to.
+        :param log: Function called with log messages.
+
+        Returns the reply of the worker, a dictionary with the return code
+        of the command, its runtime, the startup time of the worker, its
+        pid, and whether it has been started for this command. Returns
+        None if no worker is available or the worker died in which case
+        the command has to be run some other way.
+        """
+        return self._send(
+            make_request(prog=prog, args=args, cwd=cwd, stdout=stdout,
+                         stderr=stderr),
+            description=str(args), log=log)
+
+    def run_batch(self, requests, log):
+        """
+        Run many commands one after another in one of the workers.
+
+        :param requests: List of commands created with make_request().
+        :param log: Function called with log messages.
+
+        Same as run() but the reply has the replies of all commands in
+        ``replies`` instead of the return code and the runtime.
+        """
+        return self._send({"batch": requests},
+                          description="a batch of %i commands" % len(requests),
+                          log=log)
+
+    def _send(self, request, description, log):
+        request = json.dumps(request).encode() + b"\n"
+
+        with self._acquire() as index:
+            if index is None:
+                log("All %i %s worker(s) are busy." % (self.size, self.name))
+                return None
+
+            started_worker = False
+            try:
+                sock = self._connect(index)
+            except OSError:
+                sock = self._start(index, log)
+                if sock is None:
+                    return None
+                started_worker = True
+
+            with sock:
+                try:
+                    sock.sendall(request)
+                    reply = sock.makefile("rb").readline()
+                except OSError as e:
+                    reply = b""
+                    log("Lost connection to %s worker %i: %s" % (
+                        self.name, index, str(e)))
+            if not reply:
+                log("%s worker %i died while running %s. See '%s'." % (
+                    self.name, index, description,
+                    self._log_filename(index)))
+                return None
+            reply = json.loads(reply.decode())
+            reply["started_worker"] = started_worker
+            return reply
+
+
+def _run_command(function, request):
+    """
+    Call the entry point with the arguments of the request and the stdout
+    and stderr file descriptors pointing to the files of the request.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    saved_argv = sys.argv
+    saved_cwd = os.getcwd()
+
+    start = time.time()
+    with open(request["stdout"], "ab") as stdout, \
+            open(request["stderr"], "ab") as stderr:
+        os.dup2(stdout.fileno(), 1)
+        os.dup2(stderr.fileno(), 2)
+        try:
+            os.chdir(request["cwd"])
+            sys.argv = [request["prog"]] + request["args"]
+            function()
+            returncode = 0
+        except SystemExit as e:
+            if e.code is None:
+                returncode = 0
+            elif isinstance(e.code, int):
+                returncode = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except BaseException:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            # Figures of plotting commands would pile up otherwise.
+            if "matplotlib.pyplot" in sys.modules:
+                sys.modules["matplotlib.pyplot"].close("all")
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+            os.chdir(saved_cwd)
+            sys.argv = saved_argv
+
+    return {"returncode": returncode, "runtime": time.time() - start}
+
+
+class _SharedHDF5File():
+    """
+    An HDF5 file opened for reading that stays open when a command closes
+    it.
+    """
+    def __init__(self, f):
+        self._f = f
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __getitem__(self, key):
+        return self._f[key]
+
+    def __contains__(self, key):
+        return key in self._f
+
+    def __iter__(self):
+        return iter(self._f)
+
+    def __len__(self):
+        return len(self._f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def _shared_hdf5_files():
+    """
+    Open each HDF5 file that is only read once for all commands in the
+    context.
+    """
+    h5py = sys.modules.get("h5py")
+    if h5py is None:
+        yield
+        return
+
+    open_file = h5py.File
+    files = {}
+
+    def _open_shared_file(name, mode=None, *args, **kwargs):
+        # Anything else might write or depend on other options.
+        if mode != "r" or args or kwargs or not isinstance(name, str):
+            return open_file(name, mode, *args, **kwargs)
+        key = os.path.abspath(name)
+        if key not in files:
+            files[key] = open_file(name, "r")
+        return _SharedHDF5File(files[key])
+
+    h5py.File = _open_shared_file
+    try:
+        yield
+    finally:
+        h5py.File = open_file
+        for f in files.values():
+            f.close()
+
+
+def _run_and_report(function, request, after_command=None):
+    print("Running %s in '%s'." % (request["args"], request["cwd"]),
+          flush=True)
+    reply = _run_command(function, request)
+    if after_command is not None:
+        after_command(request["args"])
+    print("Finished with code %i in %.2f seconds." % (
+        reply["returncode"], reply["runtime"]), flush=True)
+    return reply
+
+
+def run_batch(function, requests, after_command=None):
+    """
+    Run many commands one after another. HDF5 files opened for reading are
+    shared between all of them.
+
+    Returns the replies of all commands with their return codes, their
+    runtimes, and the pid of the process.
+    """
+    replies = []
+    with _shared_hdf5_files():
+        for request in requests:
+            reply = _run_and_report(function, request, after_command)
+            reply["pid"] = os.getpid()
+            replies.append(reply)
+    return replies
+
+
+def _setup_lasif(project):
+    """
+    Keep the communicators of LASIF projects open between commands and open
+    the project once. Returns the function to call after each command.
+    """
+    from lasif.scripts import lasif_cli
+
+    find_project_comm = lasif_cli._find_project_comm
+    communicators = {}
+
+    def _project_state(folder):
+        # Iterations and events are changed by commands running outside of
+        # the worker.
+        state = []
+        for name in ["config.xml", "ITERATIONS", "EVENTS"]:
+            with contextlib.suppress(OSError):
+                state.append(os.stat(os.path.join(folder, name)).st_mtime)
+        return state
+
+    def _cached_find_project_comm(folder, *args, **kwargs):
+        key = json.dumps([os.path.abspath(folder), args,
+                          sorted(kwargs.items()), _project_state(folder)])
+        if key not in communicators:
+            communicators.clear()
+            communicators[key] = find_project_comm(folder, *args, **kwargs)
+        return communicators[key]
+
+    lasif_cli._find_project_comm = _cached_find_project_comm
+    _cached_find_project_comm(project, read_only_caches=True)
+
+    def _after_command(args):
+        if not args or args[0] not in LASIF_READ_ONLY_COMMANDS:
+            communicators.clear()
+
+    return _after_command
+
+
+def serve(socket_filename, lock_filename, function, started, idle_timeout,
+          after_command=None):
+    """
+    Run the commands sent to the socket until idle for ``idle_timeout``
+    seconds.
+    """
+    startup = time.time() - started
+    print("Ready after %.2f seconds." % startup, flush=True)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_filename)
+    finally:
+        os.umask(umask)
+    server.listen(1)
+    server.settimeout(idle_timeout)
+
+    with open(lock_filename, "a") as lock:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                # Only exit if no client is about to send a command.
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                os.remove(socket_filename)
+                server.close()
+                print("Idle for %.0f seconds. Exiting." % idle_timeout,
+                      flush=True)
+                return
+
+            with conn:
+                conn.settimeout(None)
+                request = json.loads(conn.makefile("rb").readline().decode())
+                if "batch" in request:
+                    reply = {"replies": run_batch(function, request["batch"],
+                                                  after_command)}
+                else:
+                    reply = _run_and_report(function, request, after_command)
+                reply.update({"startup": startup, "pid": os.getpid()})
+                with contextlib.suppress(OSError):
+                    conn.sendall(json.dumps(reply).encode() + b"\n")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--socket")
+    parser.add_argument("--lock")
+    parser.add_argument("--batch",
+                        help="JSON file with a list of commands to run "
+                             "instead of serving commands.")
+    parser.add_argument("--replies",
+                        help="JSON file the replies of the batch are "
+                             "written to.")
+    tool = parser.add_mutually_exclusive_group(required=True)
+    tool.add_argument("--entry-point", help="module:function of the tool.")
+    tool.add_argument("--script",
+                      help="Script of the tool which is run for every "
+                           "command.")
+    parser.add_argument("--preload", action="append", default=[],
+                        help="Module to import at startup.")
+    parser.add_argument("--lasif-project",
+                        help="Keep this LASIF project open.")
+    parser.add_argument("--started", type=float, default=time.time(),
+                        help="Time the worker has been started by the "
+                             "client.")
+    parser.add_argument("--idle-timeout", type=float, default=3600.0)
+    args = parser.parse_args(argv)
+    if args.batch is not None:
+        if args.replies is None:
+            parser.error("--batch requires --replies.")
+    elif args.socket is None or args.lock is None:
+        parser.error("--socket and --lock are required without --batch.")
+
+    for module in args.preload:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print("Could not preload '%s': %s" % (module, str(e)), flush=True)
+
+    if args.script:
+        # Modules imported by the script stay imported for the next
+        # command.
+        function = functools.partial(runpy.run_path, args.script,
+                                     run_name="__main__")
+    else:
+        module, name = args.entry_point.split(":")
+        function = getattr(importlib.import_module(module), name)
+
+    after_command = None
+    if args.lasif_project:
+        after_command = _setup_lasif(args.lasif_project)
+
+    if args.batch is not None:
+        with open(args.batch, "rt") as fh:
+            requests = json.load(fh)
+        replies = run_batch(function, requests, after_command=after_command)
+        temp_filename = args.replies + ".tmp"
+        with open(temp_filename, "wt") as fh:
+            json.dump(replies, fh)
+        os.replace(temp_filename, args.replies)
+        return
+
+    serve(socket_filename=args.socket, lock_filename=args.lock,
+          function=function, started=args.started,
+          idle_timeout=args.idle_timeout, after_command=after_command)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])